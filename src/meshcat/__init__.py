@@ -1,5 +1,6 @@
 import os
 
+from . import codec
 from . import commands
 from . import geometry
 from . import visualizer
@@ -1,43 +1,171 @@
-import tempfile
 import tarfile
 import os.path
+import shutil
 import subprocess
 
-import bisect
+import numpy as np
+
 from . import transformations as tf
+from .geometry import pack_typed_array
 
 
 class AnimationTrack(object):
-    __slots__ = ["name", "jstype", "frames", "values"]
+    """
+    The keyframes of one property. They are kept in NumPy arrays which grow
+    by doubling, and are sorted by frame only when they are read, so adding
+    keyframes one at a time or many at once takes amortized constant time
+    per keyframe, in any order.
+
+    `frames` and `values` are read-only NumPy views of those arrays, not
+    lists, and are only valid until the next keyframe is added. Values may
+    be promoted, e.g. from int to float, but a track can't mix booleans and
+    numbers.
+    """
+    __slots__ = ["name", "jstype", "frame_buffer", "value_buffer", "size", "is_sorted"]
 
     def __init__(self, name, jstype, frames=None, values=None):
         self.name = name
         self.jstype = jstype
-        if frames is None:
-            self.frames = []
-        else:
-            self.frames = frames
-        if values is None:
-            self.values = []
-        else:
-            self.values = values
+        self.frame_buffer = None
+        self.value_buffer = None
+        self.size = 0
+        self.is_sorted = True
+        if frames is not None and len(frames) > 0:
+            self.set_properties(frames, values)
+
+    @property
+    def frames(self):
+        if self.frame_buffer is None:
+            return np.empty(0)
+        self.sort()
+        return read_only(self.frame_buffer[:self.size])
+
+    @property
+    def values(self):
+        if self.value_buffer is None:
+            return np.empty(0)
+        self.sort()
+        return read_only(self.value_buffer[:self.size])
+
+    def sort(self):
+        if self.is_sorted:
+            return
+        # A stable sort keeps keyframes at the same frame in the order in
+        # which they were set.
+        order = np.argsort(self.frame_buffer[:self.size], kind="stable")
+        self.frame_buffer[:self.size] = self.frame_buffer[order]
+        self.value_buffer[:self.size] = self.value_buffer[order]
+        self.is_sorted = True
+
+    def reserve(self, size, value_shape, value_dtype):
+        """
+        Make room for size keyframes, whose values have the given shape, and
+        a dtype which may have to be promoted to, e.g. from int to float.
+        """
+        if self.frame_buffer is None:
+            capacity = max(size, 16)
+            self.frame_buffer = np.empty(capacity)
+            self.value_buffer = np.empty((capacity,) + value_shape, dtype=value_dtype)
+            return
+        if (self.value_buffer.dtype.kind == "b") != (np.dtype(value_dtype).kind == "b"):
+            raise ValueError("Can not mix booleans and numbers in the {:s} track, got {} values after {} values".format(
+                self.name, np.dtype(value_dtype), self.value_buffer.dtype))
+        dtype = np.result_type(self.value_buffer.dtype, value_dtype)
+        capacity = len(self.frame_buffer)
+        if size > capacity or dtype != self.value_buffer.dtype:
+            if size > capacity:
+                capacity = max(size, 2 * capacity)
+            frame_buffer = np.empty(capacity)
+            frame_buffer[:self.size] = self.frame_buffer[:self.size]
+            value_buffer = np.empty((capacity,) + self.value_buffer.shape[1:], dtype=dtype)
+            value_buffer[:self.size] = self.value_buffer[:self.size]
+            self.frame_buffer, self.value_buffer = frame_buffer, value_buffer
 
     def set_property(self, frame, value):
-        i = bisect.bisect(self.frames, frame)
-        self.frames.insert(i, frame)
-        self.values.insert(i, value)
-
-    def lower(self):
+        # Most keyframes are a number or a short list of numbers, which can
+        # be stored as they are while there's room for them.
+        buffer = self.value_buffer
+        if buffer is None or self.size == len(buffer) or not fits(value, buffer):
+            value = np.asarray(value)
+            self.reserve(self.size + 1, value.shape, value.dtype)
+        if self.size > 0 and frame < self.frame_buffer[self.size - 1]:
+            self.is_sorted = False
+        self.frame_buffer[self.size] = frame
+        self.value_buffer[self.size] = value
+        self.size += 1
+
+    def set_properties(self, frames, values):
+        """
+        Add one keyframe per entry of frames, whose value is the
+        corresponding entry of values.
+        """
+        frames = np.asarray(frames, dtype=np.float64)
+        values = np.asarray(values)
+        if len(frames) != len(values):
+            raise ValueError("Got {:d} frames but {:d} values".format(len(frames), len(values)))
+        start = self.size
+        self.reserve(start + len(frames), values.shape[1:], values.dtype)
+        self.frame_buffer[start:start + len(frames)] = frames
+        self.value_buffer[start:start + len(frames)] = values
+        self.size += len(frames)
+        if np.any(np.diff(self.frame_buffer[max(start - 1, 0):self.size]) < 0):
+            self.is_sorted = False
+
+    def lower(self, columnar=False):
+        """
+        Lower the track to a list of keys, each with a time and a value. If
+        columnar is True, lower it to the columnar form of a three.js
+        KeyframeTrack instead: the frames, and the values of all keyframes
+        flattened one after another, each as a Float32Array. Values which are
+        not numbers, e.g. strings, are sent as a plain list instead. Only
+        viewers which decode typed arrays in tracks accept the columnar form.
+        """
+        if not columnar:
+            return {
+                u"name": str("." + self.name),
+                u"type": str(self.jstype),
+                u"keys": [{
+                    u"time": time,
+                    u"value": value
+                } for time, value in zip(self.frames.tolist(), self.values.tolist())]
+            }
+        values = self.values
+        if values.dtype.kind in "fiu":
+            values = pack_typed_array(values.astype(np.float32).ravel())
+        else:
+            values = values.ravel().tolist()
         return {
             u"name": str("." + self.name),
             u"type": str(self.jstype),
-            u"keys": [{
-                u"time": self.frames[i],
-                u"value": self.values[i]
-            } for i in range(len(self.frames))]
+            u"times": pack_typed_array(self.frames.astype(np.float32)),
+            u"values": values
         }
 
 
+def read_only(array):
+    array.flags.writeable = False
+    return array
+
+
+def fits(value, buffer):
+    """
+    Whether value, a Python scalar or list, can be stored in buffer, a
+    float, int or bool array of keyframe values, as it is.
+    """
+    kind = buffer.dtype.kind
+    if buffer.ndim == 1:
+        if type(value) is float:
+            return kind == "f"
+        if type(value) is int:
+            return kind in "fi"
+        if type(value) is bool:
+            return kind == "b"
+        return False
+    if buffer.ndim == 2 and type(value) in (list, tuple) and len(value) == buffer.shape[1]:
+        return kind == "f" and all(type(v) in (float, int) for v in value)
+    return False
+
+
 class AnimationClip(object):
     __slots__ = ["tracks", "fps", "name"]
 
@@ -55,11 +183,16 @@ class AnimationClip(object):
         track = self.tracks[property]
         track.set_property(frame, value)
 
-    def lower(self):
+    def set_properties(self, frames, property, jstype, values):
+        if property not in self.tracks:
+            self.tracks[property] = AnimationTrack(property, jstype)
+        self.tracks[property].set_properties(frames, values)
+
+    def lower(self, columnar=False):
         return {
             u"fps": self.fps,
             u"name": str(self.name),
-            u"tracks": [t.lower() for t in self.tracks.values()]
+            u"tracks": [t.lower(columnar) for t in self.tracks.values()]
         }
 
 
@@ -73,15 +206,32 @@ class Animation(object):
             self.clips = clips
         self.default_framerate = default_framerate
 
-    def lower(self):
+    def lower(self, columnar=False):
         return [{
             u"path": path.lower(),
-            u"clip": clip.lower()
+            u"clip": clip.lower(columnar)
         } for (path, clip) in self.clips.items()]
 
     def at_frame(self, visualizer, frame):
         return AnimationFrameVisualizer(self, visualizer.path, frame)
 
+    def get_clip(self, path):
+        if path not in self.clips:
+            self.clips[path] = AnimationClip(fps=self.default_framerate)
+        return self.clips[path]
+
+    def set_trajectory(self, visualizer, frames, matrices):
+        """
+        Animate the transform of visualizer's path with one keyframe per
+        entry of frames, given by the corresponding (4, 4) homogeneous
+        transform in matrices. This is equivalent to calling set_transform
+        at each frame, but converts all of the matrices at once.
+        """
+        matrices = np.asarray(matrices, dtype=np.float64)
+        clip = self.get_clip(visualizer.path)
+        clip.set_properties(frames, u"position", u"vector3", js_positions(matrices))
+        clip.set_properties(frames, u"quaternion", u"quaternion", js_quaternions(matrices))
+
 
 def js_position(matrix):
     return list(matrix[:3, 3])
@@ -92,6 +242,37 @@ def js_quaternion(matrix):
     return [quat[1], quat[2], quat[3], quat[0]]
 
 
+def js_positions(matrices):
+    return matrices[:, :3, 3]
+
+
+def js_quaternions(matrices):
+    """
+    Convert a (T, 4, 4) array of transforms to a (T, 4) array of [x, y, z,
+    w] quaternions, with the same method as tf.quaternion_from_matrix.
+    """
+    M = matrices
+    # The lower triangle of the symmetric matrix K, for every transform
+    K = np.zeros((len(M), 4, 4))
+    K[:, 0, 0] = M[:, 0, 0] - M[:, 1, 1] - M[:, 2, 2]
+    K[:, 1, 0] = M[:, 0, 1] + M[:, 1, 0]
+    K[:, 1, 1] = M[:, 1, 1] - M[:, 0, 0] - M[:, 2, 2]
+    K[:, 2, 0] = M[:, 0, 2] + M[:, 2, 0]
+    K[:, 2, 1] = M[:, 1, 2] + M[:, 2, 1]
+    K[:, 2, 2] = M[:, 2, 2] - M[:, 0, 0] - M[:, 1, 1]
+    K[:, 3, 0] = M[:, 2, 1] - M[:, 1, 2]
+    K[:, 3, 1] = M[:, 0, 2] - M[:, 2, 0]
+    K[:, 3, 2] = M[:, 1, 0] - M[:, 0, 1]
+    K[:, 3, 3] = M[:, 0, 0] + M[:, 1, 1] + M[:, 2, 2]
+    K /= 3.0
+    # The quaternion is the eigenvector of K with the largest eigenvalue,
+    # already in [x, y, z, w] order.
+    w, V = np.linalg.eigh(K)
+    quats = V[np.arange(len(M)), :, np.argmax(w, axis=1)]
+    quats[quats[:, 3] < 0] *= -1
+    return quats
+
+
 class AnimationFrameVisualizer(object):
     __slots__ = ["animation", "path", "current_frame"]
 
@@ -101,9 +282,7 @@ class AnimationFrameVisualizer(object):
         self.current_frame = current_frame
 
     def get_clip(self):
-        if self.path not in self.animation.clips:
-            self.animation.clips[self.path] = AnimationClip(fps=self.animation.default_framerate)
-        return self.animation.clips[self.path]
+        return self.animation.get_clip(self.path)
 
     def set_transform(self, matrix):
         clip = self.get_clip()
@@ -129,46 +308,38 @@ def convert_frames_to_video(tar_file_path, output_path="output.mp4", framerate=6
     Try to convert a tar file containing a sequence of frames saved by the
     meshcat viewer into a single video file.
 
-    This relies on having `ffmpeg` installed on your system.
+    The frames are streamed from the archive into ffmpeg's stdin, so nothing
+    is extracted to disk. This relies on having `ffmpeg` installed on your
+    system.
     """
     output_path = os.path.abspath(output_path)
     if os.path.isfile(output_path) and not overwrite:
         raise ValueError("The output path {:s} already exists. To overwrite that file, you can pass overwrite=True to this function.".format(output_path))
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        with tarfile.open(tar_file_path) as tar:
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(tar, tmp_dir)
-        args = ["ffmpeg",
-                "-r", str(framerate),
-                "-i", r"%07d.png",
-                "-vcodec", "libx264",
-                "-preset", "slow",
-                "-pix_fmt", "yuv420p",
-                "-crf", "18"]
-        if overwrite:
-            args.append("-y")
-        args.append(output_path)
+    args = ["ffmpeg",
+            "-r", str(framerate),
+            "-f", "image2pipe",
+            "-i", "-",
+            "-vcodec", "libx264",
+            "-preset", "slow",
+            "-pix_fmt", "yuv420p",
+            "-crf", "18"]
+    if overwrite:
+        args.append("-y")
+    args.append(output_path)
+    with tarfile.open(tar_file_path) as tar:
+        # The frames are named by number, e.g. 0000000.png
+        members = sorted((m for m in tar.getmembers() if m.isfile()), key=lambda m: m.name)
         try:
-            subprocess.check_call(args, cwd=tmp_dir)
-        except subprocess.CalledProcessError as e:
+            with subprocess.Popen(args, stdin=subprocess.PIPE) as process:
+                try:
+                    for member in members:
+                        shutil.copyfileobj(tar.extractfile(member), process.stdin)
+                except BrokenPipeError:
+                    # ffmpeg gave up early, and reports why through its exit status.
+                    pass
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, args)
+        except (OSError, subprocess.CalledProcessError):
             print("""
 Could not call `ffmpeg` to convert your frames into a video.
 If you want to convert the frames manually, you can extract the
@@ -178,6 +349,3 @@ ffmpeg -r 60 -i %07d.png -vcodec libx264 -preset slow -pix_fmt yuv420p -crf 18 o
             raise
     print("Saved output as {:s}".format(output_path))
     return output_path
-
-
-
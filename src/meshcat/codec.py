@@ -0,0 +1,133 @@
+"""
+Msgpack encoding for meshcat commands.
+
+The compiled `msgpack` package is used when it is installed, since it is
+much faster than the pure-Python `umsgpack` on large payloads. Otherwise we
+fall back to `umsgpack`. Either way, typed arrays are represented in lowered
+commands as `umsgpack.Ext` objects, so the rest of meshcat does not need to
+know which backend is in use.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import struct
+
+import umsgpack
+
+# Typed arrays at least this large are sent as separate ZMQ frames rather than
+# being copied into the msgpack blob. This must be at least 2**16 so that the
+# array is always encoded as an ext32 object (see `packb_frames`).
+OUT_OF_BAND_MIN_SIZE = 2**16
+
+
+class ArrayExt(umsgpack.Ext):
+    """
+    A typed-array extension which keeps a reference to a contiguous numpy
+    array instead of copying it into a bytes object. The bytes are only
+    materialized if the array has to be packed inline.
+    """
+    def __init__(self, type, array):
+        if not (-2**7 <= type <= 2**7 - 1):
+            raise ValueError("ext type value {:d} is out of range (-128 to 127)".format(type))
+        self.type = type
+        self.array = array
+
+    @property
+    def data(self):
+        return self.array.tobytes()
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def buffer(self):
+        return memoryview(self.array).cast("B")
+
+
+class UmsgpackCodec(object):
+    name = "umsgpack"
+
+    def packb(self, obj):
+        return umsgpack.packb(obj)
+
+    def unpackb(self, data):
+        return umsgpack.unpackb(data)
+
+
+class MsgpackCodec(object):
+    name = "msgpack"
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def default(self, obj):
+        if isinstance(obj, umsgpack.Ext):
+            return self.msgpack.ExtType(obj.type, obj.data)
+        raise TypeError("Can not serialize {!r}".format(obj))
+
+    def ext_hook(self, code, data):
+        return umsgpack.Ext(code, data)
+
+    def packb(self, obj):
+        return self.msgpack.packb(obj, use_bin_type=True, default=self.default)
+
+    def unpackb(self, data):
+        return self.msgpack.unpackb(data, raw=False, ext_hook=self.ext_hook,
+                                    strict_map_key=False)
+
+
+def default_codec():
+    try:
+        return MsgpackCodec()
+    except ImportError:
+        return UmsgpackCodec()
+
+
+codec = default_codec()
+
+
+def packb(obj):
+    return codec.packb(obj)
+
+
+def unpackb(data):
+    return codec.unpackb(data)
+
+
+def packb_frames(obj, min_size=OUT_OF_BAND_MIN_SIZE):
+    """
+    Pack `obj` into a list of buffers whose concatenation is exactly
+    `packb(obj)`. Each `ArrayExt` of at least `min_size` bytes gets a buffer of
+    its own which refers to the array's memory, so it can be handed to ZMQ
+    with `copy=False` instead of being copied into the packed message.
+    """
+    arrays = []
+
+    def substitute(x):
+        if isinstance(x, dict):
+            return {k: substitute(v) for (k, v) in x.items()}
+        elif isinstance(x, (list, tuple)):
+            return [substitute(v) for v in x]
+        elif isinstance(x, ArrayExt) and x.nbytes >= min_size:
+            # Stand in for the array with a small ext object containing a
+            # random token, which we can find in the packed header afterwards.
+            token = os.urandom(16)
+            arrays.append((token, x))
+            return umsgpack.Ext(x.type, token)
+        else:
+            return x
+
+    header = packb(substitute(obj))
+    if not arrays:
+        return [header]
+    frames = []
+    start = 0
+    for (token, ext) in arrays:
+        placeholder = b"\xd8" + struct.pack("B", ext.type & 0xff) + token
+        i = header.index(placeholder, start)
+        frames.append(header[start:i] + b"\xc9" + struct.pack(">IB", ext.nbytes, ext.type & 0xff))
+        frames.append(ext.buffer())
+        start = i + len(placeholder)
+    frames.append(header[start:])
+    return frames
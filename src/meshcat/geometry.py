@@ -1,21 +1,89 @@
 import base64
+import hashlib
 import uuid
 from io import StringIO, BytesIO
-import umsgpack
 import numpy as np
 
 from . import transformations as tf
+from .codec import ArrayExt, packb
+
+
+def content_uuid(data):
+    """
+    Derive a UUID from the lowered data of a scene element (ignoring its own
+    uuid), so that elements with identical contents get identical UUIDs.
+    """
+    content = {k: v for (k, v) in data.items() if k != u"uuid"}
+    digest = hashlib.sha1(packb(content)).digest()
+    return str(uuid.UUID(bytes=digest[:16], version=5))
 
 
 class SceneElement(object):
+    # By default, every element gets a random UUID. If content_addressed is
+    # set to True (either on a single element or on this class, to affect all
+    # of them), the UUID sent to the viewer is derived from the element's
+    # contents instead. Re-creating an identical object then produces an
+    # identical set_object command, which the server does not re-send to the
+    # viewers.
+    content_addressed = False
+
+    # Lowering large geometries is expensive, so elements cache their lowered
+    # form and reuse it until one of their attributes (or one of their
+    # dependencies) is reassigned. Changes made in place, e.g. to the contents
+    # of a numpy array, are not detected; call `invalidate()` after those.
+    cache_hits = 0
+    cache_misses = 0
+
     def __init__(self):
         self.uuid = str(uuid.uuid1())
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        self.invalidate()
+
+    def invalidate(self):
+        object.__setattr__(self, "_version", getattr(self, "_version", 0) + 1)
+
+    def dependencies(self):
+        """The scene elements which this element's lowered form refers to."""
+        return ()
+
+    def lowering_state(self):
+        return (getattr(self, "_version", 0), self.content_addressed,
+                tuple(d.lowering_state() for d in self.dependencies()))
+
+    def cached(self, lower):
+        """
+        Return `lower()`, reusing the result of the previous call if neither
+        this element nor any of its dependencies has changed since.
+        """
+        state = self.lowering_state()
+        cached = getattr(self, "_lowered", None)
+        if cached is not None and cached[0] == state:
+            SceneElement.cache_hits += 1
+            return cached[1]
+        SceneElement.cache_misses += 1
+        result = lower()
+        object.__setattr__(self, "_lowered", (state, result))
+        return result
+
 
 class ReferenceSceneElement(SceneElement):
     def lower_in_object(self, object_data):
-        object_data.setdefault(self.field, []).append(self.lower(object_data))
-        return self.uuid
+        lowered, element_uuid = self.cached(self.lower_standalone)
+        for (field, elements) in lowered.items():
+            object_data.setdefault(field, []).extend(elements)
+        return element_uuid
+
+    def lower_standalone(self):
+        # Lower into a fresh dict, so that the cache also captures any
+        # textures or images which this element adds to the object.
+        object_data = {}
+        data = self.lower(object_data)
+        if self.content_addressed:
+            data[u"uuid"] = content_uuid(data)
+        object_data.setdefault(self.field, []).append(data)
+        return object_data, data[u"uuid"]
 
 
 class Geometry(ReferenceSceneElement):
@@ -148,6 +216,9 @@ class GenericMaterial(Material):
         self.vertexColors = vertexColors
         self.properties = kwargs
 
+    def dependencies(self):
+        return (self.map,) if self.map is not None else ()
+
     def lower(self, object_data):
         # Three.js allows a material to have an opacity which is != 1,
         # but to still be non-transparent, in which case the opacity only
@@ -239,6 +310,10 @@ class GenericTexture(Texture):
         super(GenericTexture, self).__init__()
         self.properties = properties
 
+    def dependencies(self):
+        image = self.properties.get(u"image")
+        return (image,) if isinstance(image, SceneElement) else ()
+
     def lower(self, object_data):
         data = {u"uuid": self.uuid}
         data.update(self.properties)
@@ -256,6 +331,9 @@ class ImageTexture(Texture):
         self.repeat = repeat
         self.properties = kwargs
 
+    def dependencies(self):
+        return (self.image,)
+
     def lower(self, object_data):
         data = {
             u"uuid": self.uuid,
@@ -273,7 +351,13 @@ class Object(SceneElement):
         self.geometry = geometry
         self.material = material
 
+    def dependencies(self):
+        return (self.geometry, self.material)
+
     def lower(self):
+        return self.cached(self.lower_uncached)
+
+    def lower_uncached(self):
         data = {
             u"metadata": {
                 u"version": 4.5,
@@ -281,16 +365,18 @@ class Object(SceneElement):
             },
             u"geometries": [],
             u"materials": [],
-            u"object": {
-                u"uuid": self.uuid,
-                u"type": self._type,
-                u"geometry": self.geometry.uuid,
-                u"material": self.material.uuid,
-                u"matrix": list(self.geometry.intrinsic_transform().flatten())
-            }
         }
-        self.geometry.lower_in_object(data)
-        self.material.lower_in_object(data)
+        geometry_uuid = self.geometry.lower_in_object(data)
+        material_uuid = self.material.lower_in_object(data)
+        data[u"object"] = {
+            u"uuid": self.uuid,
+            u"type": self._type,
+            u"geometry": geometry_uuid,
+            u"material": material_uuid,
+            u"matrix": list(self.geometry.intrinsic_transform().flatten())
+        }
+        if self.content_addressed:
+            data[u"object"][u"uuid"] = content_uuid(data[u"object"])
         return data
 
 
@@ -323,6 +409,8 @@ class OrthographicCamera(SceneElement):
                 u"zoom": self.zoom,
             }
         }
+        if self.content_addressed:
+            data[u"object"][u"uuid"] = content_uuid(data[u"object"])
         return data
 
 class PerspectiveCamera(SceneElement):
@@ -373,6 +461,8 @@ class PerspectiveCamera(SceneElement):
                 u"zoom": self.zoom,
             }
         }
+        if self.content_addressed:
+            data[u"object"][u"uuid"] = content_uuid(data[u"object"])
         return data
 
 def item_size(array):
@@ -397,14 +487,31 @@ def threejs_type(dtype):
         raise ValueError("Unsupported datatype: " + str(dtype))
 
 
+def pack_typed_array(x):
+    """
+    Pack a numpy array into a msgpack extension which the viewer decodes as a
+    typed array. Multidimensional arrays are flattened in column-major order.
+
+    The extension refers to the array's memory without a copy only if the
+    array is 1-D or Fortran-ordered, and already has a dtype the viewer
+    supports, e.g. float32. Other arrays, such as C-ordered (N, 3) float32
+    vertices, are copied once while they are flattened.
+    """
+    x = np.asarray(x)
+    if x.dtype == np.float64:
+        x = x.astype(np.float32, order='F')
+    _, extcode = threejs_type(x.dtype)
+    return ArrayExt(extcode, x.ravel(order='F'))
+
+
 def pack_numpy_array(x):
     if x.dtype == np.float64:
         x = x.astype(np.float32)
-    typename, extcode = threejs_type(x.dtype)
+    typename, _ = threejs_type(x.dtype)
     return {
         u"itemSize": item_size(x),
         u"type": typename,
-        u"array": umsgpack.Ext(extcode, x.tobytes('F')),
+        u"array": pack_typed_array(x),
         u"normalized": False
     }
 
@@ -471,7 +578,7 @@ class StlMeshGeometry(MeshGeometry):
         with open(fname, "rb") as f:
             arr = np.frombuffer(f.read(), dtype=np.uint8)
             _, extcode = threejs_type(np.uint8)
-            encoded = umsgpack.Ext(extcode, arr.tobytes())
+            encoded = ArrayExt(extcode, arr)
             return MeshGeometry(encoded, u"stl")
 
     @staticmethod
@@ -483,7 +590,7 @@ class StlMeshGeometry(MeshGeometry):
         else:
             raise ValueError('Stream must be instance of StringIO or BytesIO, not {}'.format(type(f)))
         _, extcode = threejs_type(np.uint8)
-        encoded = umsgpack.Ext(extcode, arr.tobytes())
+        encoded = ArrayExt(extcode, arr)
         return MeshGeometry(encoded, u"stl")
 
 
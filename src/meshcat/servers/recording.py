@@ -0,0 +1,170 @@
+"""
+Recording of the viewer's frames at a fixed rate. Each frame is captured
+like an image for `capture_image`, and is streamed to a sink as soon as it
+arrives, so nothing is kept in memory or on disk besides the output.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+import concurrent.futures
+import shutil
+import subprocess
+import time
+
+import tornado.ioloop
+import zmq
+
+from .. import codec
+
+# Encoder settings for recordings. The preset is faster than the one used by
+# `animation.convert_frames_to_video`, so that ffmpeg keeps up with the frames.
+FFMPEG_OUTPUT_ARGS = ["-vcodec", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-crf", "18"]
+
+# Frames which may be waiting to be written to a sink. While more are
+# waiting, new frames are skipped rather than piling up.
+MAX_BACKLOG = 30
+
+
+class FfmpegSink(object):
+    """
+    Writes frames to the stdin of an ffmpeg process encoding a video file.
+    The input format is taken from the first frame: raw RGBA pixels are read
+    as rawvideo, PNG or JPEG files through image2pipe. Frames of another
+    format or size are dropped.
+    """
+    def __init__(self, filename, fps):
+        if shutil.which("ffmpeg") is None:
+            raise RuntimeError("ffmpeg is not installed on the server")
+        self.filename = filename
+        self.fps = fps
+        self.process = None
+        self.input = None
+        # Writes to the pipe block while ffmpeg is busy, so they happen in
+        # order on a thread of their own.
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="meshcat-ffmpeg")
+        self.writes = collections.deque()
+
+    def start(self, header):
+        if header[u"format"] == u"rgba":
+            input_args = ["-f", "rawvideo", "-pix_fmt", "rgba",
+                          "-s", "{:d}x{:d}".format(header[u"width"], header[u"height"])]
+        else:
+            input_args = ["-f", "image2pipe"]
+        args = ["ffmpeg", "-y", "-loglevel", "error", "-r", str(self.fps)] + input_args + ["-i", "-"]
+        args += FFMPEG_OUTPUT_ARGS + [self.filename]
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE)
+
+    def backlog(self):
+        # The writes finish in order.
+        while self.writes and self.writes[0].done():
+            self.writes.popleft()
+        return len(self.writes)
+
+    def write(self, header, data):
+        if self.process is None:
+            self.start(header)
+            self.input = (header[u"format"], header[u"width"], header[u"height"])
+        elif (header[u"format"], header[u"width"], header[u"height"]) != self.input:
+            return False
+        self.writes.append(self.executor.submit(self.write_frame, data))
+        return True
+
+    def write_frame(self, data):
+        try:
+            self.process.stdin.write(data)
+        except (BrokenPipeError, ValueError):
+            # ffmpeg exited early; close reports its exit status.
+            pass
+
+    def close(self):
+        """Return a future of ffmpeg's exit status, once it has finished."""
+        future = self.executor.submit(self.finish)
+        self.executor.shutdown(wait=False)
+        return future
+
+    def finish(self):
+        if self.process is None:
+            return 0
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return self.process.wait()
+
+
+class PublishSink(object):
+    """
+    Publishes each frame on a ZMQ PUB socket as two frames: a msgpack header
+    with the "format", "width", "height", "frame" number and capture "time"
+    of the image, followed by the image data.
+    """
+    def __init__(self, context, url):
+        self.socket = context.socket(zmq.PUB)
+        self.socket.bind(url)
+
+    def backlog(self):
+        # A PUB socket drops messages for slow subscribers by itself.
+        return 0
+
+    def write(self, header, data):
+        self.socket.send_multipart([codec.packb(header), data], copy=False)
+        return True
+
+    def close(self):
+        self.socket.close(linger=0)
+        future = concurrent.futures.Future()
+        future.set_result(0)
+        return future
+
+
+class Recorder(object):
+    """
+    Asks the viewers for a frame fps times per second, and writes the frames
+    to sink in order. A tick is skipped while the previous frame has not
+    arrived yet, or while the sink is backed up, so a slow viewer gives a
+    video with fewer frames rather than a growing delay.
+    """
+    def __init__(self, bridge, sink, fps, request):
+        self.bridge = bridge
+        self.sink = sink
+        self.request = request
+        self.frames = 0
+        self.skipped = 0
+        self.capturing = False
+        self.stopped = False
+        self.callback = tornado.ioloop.PeriodicCallback(self.capture, 1000.0 / fps)
+
+    def start(self):
+        self.callback.start()
+
+    def capture(self):
+        if self.capturing or self.sink.backlog() >= MAX_BACKLOG or not self.bridge.websocket_pool:
+            self.skipped += 1
+            return
+        self.capturing = True
+        self.bridge.capture_image(self.request, self.on_frame, True, self.request.get(u"viewer"))
+
+    def on_frame(self, response):
+        self.capturing = False
+        if self.stopped:
+            return
+        if not isinstance(response, list):
+            # An error, e.g. the viewer closed before sending the frame
+            self.skipped += 1
+            return
+        header = codec.unpackb(response[0])
+        header[u"frame"] = self.frames
+        header[u"time"] = time.time()
+        if self.sink.write(header, response[1]):
+            self.frames += 1
+        else:
+            self.skipped += 1
+
+    def stop(self):
+        """Stop capturing, and return a future of the sink's exit status."""
+        self.stopped = True
+        self.callback.stop()
+        return self.sink.close()
+
+    def stats(self):
+        return {"frames": self.frames, "skipped": self.skipped}
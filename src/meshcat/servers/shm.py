@@ -0,0 +1,127 @@
+"""
+A shared-memory transport for clients running on the same host as the
+server. The client writes the msgpack-encoded data of each command into a ring
+buffer in a memory-mapped file and sends only a small descriptor over ZMQ:
+
+    [type, path, SHM_MARKER, descriptor]
+
+where the descriptor holds the offset and length of the data in the file. The
+server acknowledges a command only after it has copied the data out, so the
+client can reuse a region of the ring as soon as the acknowledgment arrives.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+import mmap
+import os
+import struct
+import tempfile
+import weakref
+
+SHM_MARKER = b"shm"
+DEFAULT_SHM_SIZE = 64 * 2**20
+_DESCRIPTOR = struct.Struct("<QQ")
+
+
+def shm_directory():
+    # /dev/shm is backed by memory on Linux. Elsewhere, the page cache will
+    # have to do.
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return None
+
+
+def pack_descriptor(offset, nbytes):
+    return _DESCRIPTOR.pack(offset, nbytes)
+
+
+def unpack_descriptor(descriptor):
+    return _DESCRIPTOR.unpack(descriptor)
+
+
+class ShmWriter(object):
+    """
+    The client side of the transport. Regions are allocated in order and
+    released in the same order as their commands are acknowledged.
+    """
+    def __init__(self, size=DEFAULT_SHM_SIZE):
+        fd, self.path = tempfile.mkstemp(prefix="meshcat-", suffix=".shm", dir=shm_directory())
+        try:
+            os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.size = size
+        self.head = 0
+        self.regions = collections.deque()
+        # Remove the file when the writer is closed, garbage collected or at
+        # exit, whichever comes first.
+        self.finalizer = weakref.finalize(self, remove_shm, self.mmap, self.path)
+
+    def allocate(self, nbytes):
+        """
+        Reserve `nbytes` of the ring and return their offset, or None if
+        there is not enough free space until more regions are released.
+        """
+        if not self.regions:
+            self.head = 0
+            start = 0 if nbytes <= self.size else None
+        else:
+            oldest = self.regions[0][0]
+            if self.head > oldest:
+                # The regions in use are [oldest, head), so we can either
+                # append after them or wrap around to the start.
+                if nbytes <= self.size - self.head:
+                    start = self.head
+                elif nbytes <= oldest:
+                    start = 0
+                else:
+                    start = None
+            else:
+                # We have already wrapped around, so only [head, oldest) is free
+                start = self.head if nbytes <= oldest - self.head else None
+        if start is None:
+            return None
+        self.head = start + nbytes
+        self.regions.append((start, self.head))
+        return start
+
+    def write(self, offset, buffers):
+        for buf in buffers:
+            buf = memoryview(buf).cast("B")
+            self.mmap[offset:offset + buf.nbytes] = buf
+            offset += buf.nbytes
+
+    def release(self):
+        self.regions.popleft()
+
+    def reset(self):
+        self.regions.clear()
+        self.head = 0
+
+    def close(self):
+        self.finalizer()
+
+
+def remove_shm(mmap, path):
+    mmap.close()
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ShmReader(object):
+    """
+    The server side of the transport.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, descriptor):
+        offset, nbytes = unpack_descriptor(descriptor)
+        if offset + nbytes > len(self.mmap):
+            raise ValueError("Shared memory region [{:d}, {:d}) is out of bounds".format(offset, offset + nbytes))
+        return self.mmap[offset:offset + nbytes]
@@ -1,27 +1,95 @@
 from __future__ import absolute_import, division, print_function
 
-from collections import defaultdict
+import sys
 
-class TreeNode(defaultdict):
-    __slots__ = ["object", "transform", "properties", "animation"]
 
-    def __init__(self, *args, **kwargs):
-        super(TreeNode, self).__init__(*args, **kwargs)
+class TreeNode(object):
+    __slots__ = ["children", "object", "transform", "properties", "animation"]
+
+    def __init__(self):
+        self.children = {}
         self.object = None
-        self.properties = []
+        # Only the latest value of each property is kept, keyed by name
+        self.properties = {}
         self.transform = None
         self.animation = None
 
-SceneTree = lambda: TreeNode(SceneTree)
+
+class SceneTree(object):
+    """
+    The server's copy of the scene. Nodes are kept in a tree, so that we can
+    delete a subtree or walk the scene in order, and also in a flat index
+    from path to node, so that finding a node takes a single dict lookup.
+
+    Paths are tuples of interned path components, as returned by
+    `parse_path`. Only `get` creates nodes; `find` never does.
+    """
+    # Parsed paths are cached, but we don't want the cache to grow without
+    # bound if a client keeps inventing new paths.
+    MAX_PARSED_PATHS = 100000
+
+    def __init__(self):
+        self.root = TreeNode()
+        self.index = {(): self.root}
+        self.parsed_paths = {}
+
+    def parse_path(self, path):
+        """
+        Convert a slash-separated path (as str or utf-8 encoded bytes) into a
+        tuple of path components.
+        """
+        parsed = self.parsed_paths.get(path)
+        if parsed is None:
+            if isinstance(path, bytes):
+                text = path.decode("utf-8")
+            else:
+                text = path
+            parsed = tuple(sys.intern(p) for p in text.split("/") if len(p) > 0)
+            if len(self.parsed_paths) >= self.MAX_PARSED_PATHS:
+                self.parsed_paths.clear()
+            self.parsed_paths[path] = parsed
+        return parsed
+
+    def find(self, path):
+        """Return the node at `path`, or None if there is none."""
+        return self.index.get(path)
+
+    def get(self, path):
+        """Return the node at `path`, creating it and its parents if needed."""
+        node = self.index.get(path)
+        if node is None:
+            parent = self.get(path[:-1])
+            node = TreeNode()
+            parent.children[path[-1]] = node
+            self.index[path] = node
+        return node
+
+    def delete(self, path):
+        """Delete the node at `path` and everything below it."""
+        if len(path) == 0:
+            raise ValueError("Cannot delete the root of the tree")
+        parent = self.index.get(path[:-1])
+        if parent is None or path[-1] not in parent.children:
+            return
+        node = parent.children.pop(path[-1])
+        stack = [(path, node)]
+        while stack:
+            p, n = stack.pop()
+            del self.index[p]
+            stack.extend((p + (name,), child) for (name, child) in n.children.items())
+
+    def walk(self):
+        """Yield every node, parents before their children."""
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(list(node.children.values())))
+
 
 def walk(tree):
-    yield tree
-    for v in tree.values():
-        for t in walk(v):  # could use `yield from` if we didn't need python2
-            yield t
+    return tree.walk()
+
 
 def find_node(tree, path):
-    if len(path) == 0:
-        return tree
-    else:
-        return find_node(tree[path[0]], path[1:])
+    return tree.get(tuple(path))
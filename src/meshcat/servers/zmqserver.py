@@ -2,23 +2,39 @@ from __future__ import absolute_import, division, print_function
 
 import atexit
 import base64
+import collections
+import functools
+import itertools
 import os
 import re
 import sys
 import subprocess
 import multiprocessing
 import json
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+import umsgpack
 
 import tornado.web
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.websocket
 import tornado.gen
+import tornado.iostream
 
 import zmq
 import zmq.eventloop.ioloop
 from zmq.eventloop.zmqstream import ZMQStream
 
-from .tree import SceneTree, walk, find_node
+from .. import codec
+from .recording import Recorder, FfmpegSink, PublishSink
+from .shm import ShmReader, SHM_MARKER
+from .tree import SceneTree
 
 
 def capture(pattern, s):
@@ -34,17 +50,22 @@ def match_zmq_url(line):
 def match_web_url(line):
     return capture(r"^web_url=(.*)$", line)
 
-def start_zmq_server_as_subprocess(zmq_url=None, server_args=[]):
+def start_zmq_server_as_subprocess(zmq_url=None, server_args=[], shm_path=None):
     """
     Starts the ZMQ server as a subprocess, passing *args through popen.
     Optional Keyword Arguments:
         zmq_url
+        shm_path: a shared-memory ring buffer created by the client, which the
+                  server should read command data from (see servers/shm.py)
     """
     # Need -u for unbuffered output: https://stackoverflow.com/a/25572491
     args = [sys.executable, "-u", "-m", "meshcat.servers.zmqserver"]
     if zmq_url is not None:
         args.append("--zmq-url")
         args.append(zmq_url)
+    if shm_path is not None:
+        args.append("--shm-path")
+        args.append(shm_path)
     if server_args:
         args.append(*server_args)
     # Note: Pass PYTHONPATH to be robust to workflows like Google Colab,
@@ -79,6 +100,52 @@ def start_zmq_server_as_subprocess(zmq_url=None, server_args=[]):
     return server_proc, zmq_url, web_url
 
 
+def start_zmq_server_as_thread(zmq_url=None, server_args=[], context=None):
+    """
+    Starts the ZMQ server on a background thread of the current process,
+    which is much faster than starting a subprocess. Unless a zmq_url is
+    given, the server listens on a private inproc:// URL, so clients must use
+    the same ZMQ `context` as the server.
+
+    server_args are parsed just like the command-line arguments of
+    `meshcat-server`, except that invalid ones raise ValueError. Returns the
+    bridge, its zmq_url and its web_url. The server runs until the bridge's
+    `close` is called.
+    """
+    import asyncio
+
+    try:
+        results = server_arg_parser().parse_args(server_args)
+    except SystemExit:
+        raise ValueError("invalid server_args: {!r}".format(server_args))
+    if zmq_url is None:
+        zmq_url = "inproc://meshcat-{:s}".format(uuid.uuid4().hex)
+    results.zmq_url = zmq_url
+
+    started = threading.Event()
+    result = {}
+
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        try:
+            result["bridge"] = bridge_from_args(results, context=context)
+        except Exception as e:
+            result["error"] = e
+            return
+        finally:
+            started.set()
+        result["bridge"].run()
+        result["bridge"].ioloop.close()
+
+    thread = threading.Thread(target=run, name="meshcat-server", daemon=True)
+    thread.start()
+    started.wait()
+    if "error" in result:
+        raise result["error"]
+    bridge = result["bridge"]
+    return bridge, bridge.zmq_url, bridge.web_url
+
+
 def _zmq_install_ioloop():
     # For pyzmq<17, install ioloop instead of a tornado ioloop
     # http://zeromq.github.com/pyzmq/eventloop.html
@@ -100,8 +167,18 @@ DEFAULT_FILESERVER_PORT = 7000
 MAX_ATTEMPTS = 1000
 DEFAULT_ZMQ_METHOD = "tcp"
 DEFAULT_ZMQ_PORT = 6000
+DEFAULT_COMPRESSION_MIN_SIZE = 1024
+DEFAULT_RECORDING_FPS = 30
+
+MESHCAT_COMMANDS = ["set_transform", "set_transforms", "set_object", "delete", "set_property", "set_animation"]
+BATCH_COMMANDS = MESHCAT_COMMANDS + ["set_target"]
+# Commands which may be sent to the telemetry socket, where a lost message is
+# soon superseded by the next one.
+TELEMETRY_COMMANDS = ["set_transform", "set_transforms", "set_property"]
 
-MESHCAT_COMMANDS = ["set_transform", "set_object", "delete", "set_property", "set_animation"]
+# Formats a viewer may be asked to encode a captured image in: raw 8-bit RGBA
+# pixels, or a PNG or JPEG file.
+IMAGE_FORMATS = ["rgba", "png", "jpeg"]
 
 
 def find_available_port(func, default_port, max_attempts=MAX_ATTEMPTS, **kwargs):
@@ -118,37 +195,365 @@ def find_available_port(func, default_port, max_attempts=MAX_ATTEMPTS, **kwargs)
         raise(Exception("Could not find an available port in the range: [{:d}, {:d})".format(default_port, max_attempts + default_port)))
 
 
+class Broadcast(object):
+    """
+    A message for the viewers. If permessage-deflate compression is enabled,
+    the message is compressed once and the result is shared by every viewer
+    it is sent to. It is compressed without context takeover, which any
+    viewer can decode whatever parameters its connection negotiated.
+    """
+    __slots__ = ["data", "deflated"]
+
+    def __init__(self, data):
+        self.data = data
+        # Compressed payloads, by window size
+        self.deflated = {}
+
+    def deflate(self, compression_level, max_wbits):
+        try:
+            return self.deflated[max_wbits]
+        except KeyError:
+            compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -max_wbits)
+            payload = compressor.compress(self.data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            # The empty block which ends a sync flush is left out of the frame
+            # (see RFC 7692, section 7.2.1).
+            self.deflated[max_wbits] = payload = payload[:-4]
+            return payload
+
+
 class WebSocketHandler(tornado.websocket.WebSocketHandler):
+    # We write at most this many queued messages per ioloop iteration, so
+    # that syncing a large scene to a new viewer doesn't stall everything
+    # else.
+    SYNC_CHUNK_SIZE = 100
+
+    # A viewer which falls this many messages behind, even after superseded
+    # transforms and properties have been dropped, is disconnected rather
+    # than letting its queue grow without bound. Reloading the page syncs it
+    # up with the scene again. The scene it was sent on connecting doesn't
+    # count, however large it is.
+    MAX_QUEUE_SIZE = 10000
+
+    # Viewer IDs, unique within the process
+    ids = itertools.count(1)
+
     def __init__(self, *args, **kwargs):
         self.bridge = kwargs.pop("bridge")
+        # Outgoing messages, in order. Messages which may be superseded
+        # (transforms and properties) are keyed by what they set, all others
+        # by a unique counter.
+        self.queue = collections.OrderedDict()
+        self.queue_counter = itertools.count()
+        # How many of the scene's messages at the front of the queue are
+        # still to be written
+        self.syncing = 0
+        self.writing = False
+        self.dropped = 0
+        self.overflowed = False
+        # Identifies this viewer to capture_image requests which target it
+        self.id = next(WebSocketHandler.ids)
+        # The IDs of the capture requests sent to this viewer which it has
+        # not answered yet, in order.
+        self.captures = collections.deque()
         super(WebSocketHandler, self).__init__(*args, **kwargs)
 
+    def get_compression_options(self):
+        if self.bridge.compression_level is None:
+            return None
+        return {"compression_level": self.bridge.compression_level}
+
     def open(self):
-        self.bridge.websocket_pool.add(self)
         print("opened:", self, file=sys.stderr)
-        self.bridge.send_scene(self)
+        self.bridge.on_ingestion(self.bridge.send_scene, self)
+
+    def send(self, message, key=None):
+        """
+        Queue a Broadcast for this viewer. A message with a key replaces any
+        queued message with the same key which hasn't been written yet.
+        """
+        if self.overflowed:
+            return
+        if key is None:
+            key = next(self.queue_counter)
+        elif key in self.queue:
+            del self.queue[key]
+            self.dropped += 1
+        self.queue[key] = message
+        if len(self.queue) - self.syncing > self.MAX_QUEUE_SIZE:
+            print("closing {}: more than {:d} messages queued".format(self, self.MAX_QUEUE_SIZE), file=sys.stderr)
+            self.overflowed = True
+            self.clear_queue()
+            self.close(1013, "meshcat viewer fell too far behind")
+            return
+        self.write_queue()
+
+    def send_scene(self, messages):
+        for message in messages:
+            self.queue[next(self.queue_counter)] = message
+        self.syncing += len(messages)
+        self.write_queue()
+
+    def clear_queue(self):
+        self.queue.clear()
+        self.syncing = 0
+
+    def write_queue(self):
+        """
+        Write queued messages until the socket stops keeping up, then wait
+        for tornado to flush them before writing more.
+        """
+        if self.writing:
+            return
+        for _ in range(self.SYNC_CHUNK_SIZE):
+            if not self.queue:
+                return
+            _, message = self.queue.popitem(last=False)
+            if self.syncing:
+                self.syncing -= 1
+            try:
+                future = self.write_frame(message)
+            except (tornado.websocket.WebSocketClosedError, tornado.iostream.StreamClosedError):
+                self.clear_queue()
+                return
+            if not future.done():
+                self.writing = True
+                future.add_done_callback(self.on_write_done)
+                return
+        tornado.ioloop.IOLoop.current().add_callback(self.write_queue)
+
+    def write_frame(self, message):
+        """
+        Write a Broadcast as a single binary frame. Messages smaller than the
+        bridge's compression_min_size are sent uncompressed, which is allowed
+        per message by permessage-deflate.
+        """
+        connection = self.ws_connection
+        if connection is None or connection.is_closing():
+            raise tornado.websocket.WebSocketClosedError()
+        # tornado keeps the compressor it negotiated privately. We never use
+        # it, since its window would no longer match the viewer's once we
+        # have sent a message that it didn't compress itself.
+        compressor = getattr(connection, "_compressor", None)
+        if compressor is None:
+            return connection.write_message(message.data, binary=True)
+        if len(message.data) < self.bridge.compression_min_size:
+            return connection._write_frame(True, 0x2, message.data)
+        max_wbits = max(9, getattr(compressor, "_max_wbits", zlib.MAX_WBITS))
+        payload = message.deflate(self.bridge.compression_level, max_wbits)
+        return connection._write_frame(True, 0x2, payload, flags=connection.RSV1)
+
+    def on_write_done(self, future):
+        self.writing = False
+        if future.cancelled() or future.exception() is not None:
+            self.clear_queue()
+        else:
+            self.write_queue()
+
+    def stats(self):
+        return {
+            "id": self.id,
+            "remote_ip": self.request.remote_ip,
+            "queued": len(self.queue),
+            "dropped": self.dropped,
+            "overflowed": self.overflowed,
+        }
 
     def on_message(self, message):
         try:
+            if isinstance(message, bytes):
+                # A binary capture: a msgpack map with the image format, its
+                # size, and the pixels or encoded file as raw bytes.
+                image = codec.unpackb(message)
+                request_id = self.answered(image.get(u"request_id") if isinstance(image, dict) else None)
+                self.bridge.on_ingestion(self.bridge.receive_image, request_id, image)
+                return
             message = json.loads(message)
-            self.bridge.send_image(message['data'])
+            request_id = self.answered(message.get("request_id"))
+            self.bridge.on_ingestion(self.bridge.send_image, request_id, message['data'])
             return
         except Exception as err:
             print(err)
             raise
 
+    def answered(self, request_id):
+        """
+        Return the ID of the capture request which an image answers. Viewers
+        which do not send the ID back answer their requests in order.
+        """
+        if request_id is None:
+            return self.captures.popleft() if self.captures else None
+        if request_id in self.captures:
+            self.captures.remove(request_id)
+        return request_id
+
     def on_close(self):
-        self.bridge.websocket_pool.remove(self)
+        self.bridge.websocket_pool.discard(self)
+        if self.captures:
+            self.bridge.on_ingestion(self.bridge.viewer_closed, self.id, list(self.captures))
         print("closed:", self, file=sys.stderr)
 
 
-def create_command(data):
-    """Encode the drawing command into a Javascript fetch() command for display."""
+@functools.lru_cache(maxsize=None)
+def viewer_js_src():
+    """The viewer's javascript bundle, which is read from disk only once."""
+    with open(os.path.join(VIEWER_ROOT, "main.min.js"), "r") as f:
+        return f.read()
+
+
+def static_html(snapshot):
+    """
+    Generate a standalone HTML page which shows the scene described by the
+    given snapshot messages.
+    """
+    # All of the messages are packed into a single blob, each one prefixed by
+    # its length as a little-endian uint32, and decoded by a short loop in the
+    # page.
+    blob = bytearray()
+    for data in snapshot:
+        blob += struct.pack("<I", len(data))
+        blob += data
     return """
-fetch("data:application/octet-binary;base64,{}")
-    .then(res => res.arrayBuffer())
-    .then(buffer => viewer.handle_command_bytearray(new Uint8Array(buffer)));
-    """.format(base64.b64encode(data).decode("utf-8"))
+        <!DOCTYPE html>
+        <html>
+            <head> <meta charset=utf-8> <title>MeshCat</title> </head>
+            <body>
+                <div id="meshcat-pane">
+                </div>
+                <script>
+                    {mainminjs}
+                </script>
+                <script>
+                    var viewer = new MeshCat.Viewer(document.getElementById("meshcat-pane"));
+                    fetch("data:application/octet-binary;base64,{scene}")
+                        .then(res => res.arrayBuffer())
+                        .then(buffer => {{
+                            var view = new DataView(buffer);
+                            var offset = 0;
+                            while (offset < buffer.byteLength) {{
+                                var length = view.getUint32(offset, true);
+                                offset += 4;
+                                viewer.handle_command_bytearray(new Uint8Array(buffer.slice(offset, offset + length)));
+                                offset += length;
+                            }}
+                        }});
+                </script>
+                 <style>
+                    body {{margin: 0; }}
+                    #meshcat-pane {{
+                        width: 100vw;
+                        height: 100vh;
+                        overflow: hidden;
+                    }}
+                </style>
+                <script id="embedded-json"></script>
+            </body>
+        </html>
+    """.format(mainminjs=viewer_js_src(), scene=base64.b64encode(blob).decode("utf-8"))
+
+
+def split_set_transforms(data):
+    """
+    Split a packed set_transforms command into the frames of one
+    set_transform command per path, which is what the viewer understands.
+    Raises ValueError if the command is malformed.
+    """
+    try:
+        cmd = codec.unpackb(data)
+        paths = cmd["paths"]
+        matrices = cmd["matrices"]
+    except Exception as e:
+        raise ValueError("could not read set_transforms: {!r}".format(e))
+    if not isinstance(matrices, umsgpack.Ext) or not (
+            isinstance(paths, list) and all(isinstance(p, str) for p in paths)):
+        raise ValueError("set_transforms expects a list of paths and a packed array of matrices")
+    if len(matrices.data) != 64 * len(paths):
+        raise ValueError("set_transforms got {:d} bytes of matrices for {:d} paths, expected {:d}".format(
+            len(matrices.data), len(paths), 64 * len(paths)))
+    commands = []
+    for i, path in enumerate(paths):
+        matrix = umsgpack.Ext(matrices.type, matrices.data[i * 64:(i + 1) * 64])
+        commands.append([b"set_transform", path.encode("utf-8"), codec.packb({
+            u"type": u"set_transform",
+            u"path": path,
+            u"matrix": matrix
+        })])
+    return commands
+
+
+def read_image(image):
+    """
+    Check a binary capture sent by a viewer, and return its format, width,
+    height and data. Raises ValueError if it is malformed.
+    """
+    if not isinstance(image, dict):
+        raise ValueError("expected a map, got {!r}".format(type(image)))
+    missing = [key for key in [u"format", u"width", u"height", u"data"] if key not in image]
+    if missing:
+        raise ValueError("missing {}".format(", ".join(missing)))
+    image_format, width, height, data = image[u"format"], image[u"width"], image[u"height"], image[u"data"]
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError("unknown image format {!r}".format(image_format))
+    if not isinstance(data, bytes):
+        raise ValueError("expected the data as bytes, got {!r}".format(type(data)))
+    if image_format == "rgba":
+        if not all(isinstance(x, int) and x >= 0 for x in [width, height]):
+            raise ValueError("invalid size {!r} x {!r}".format(width, height))
+        if len(data) != 4 * width * height:
+            raise ValueError("expected {:d} bytes of rgba data, got {:d}".format(4 * width * height, len(data)))
+    return image_format, width, height, data
+
+
+def parse_timeout(timeout):
+    """
+    Check a timeout, in seconds, sent by a client. None means no timeout.
+    """
+    if timeout is None:
+        return None
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)):
+        raise ValueError("timeout must be a number, got {!r}".format(timeout))
+    if not 0 <= timeout < float("inf"):
+        raise ValueError("timeout must be non-negative and finite, got {!r}".format(timeout))
+    return float(timeout)
+
+
+class DeferredReply(object):
+    """
+    The reply to a request which the client collects later with a request
+    of its own, so that it can carry on using the socket it sent the first
+    one on in the meantime.
+    """
+    __slots__ = ["result", "reply"]
+
+    def __init__(self):
+        self.result = None
+        self.reply = None
+
+    def __call__(self, data):
+        if self.reply is None:
+            self.result = data
+        else:
+            self.reply(data)
+
+    def collect(self, reply):
+        if self.result is None:
+            self.reply = reply
+        else:
+            reply(self.result)
+
+
+class Producer(object):
+    """
+    A client of the ZMQ socket, with the requests it has sent which we
+    haven't handled yet.
+    """
+    __slots__ = ["envelope", "requests", "busy", "reply"]
+
+    def __init__(self, bridge, envelope):
+        self.envelope = envelope
+        self.requests = collections.deque()
+        # Whether we are waiting to reply to one of its requests
+        self.busy = False
+        self.reply = functools.partial(bridge.send_reply, self)
 
 
 class StaticFileHandlerNoCache(tornado.web.StaticFileHandler):
@@ -164,10 +569,66 @@ class StaticFileHandlerNoCache(tornado.web.StaticFileHandler):
 class ZMQWebSocketBridge(object):
     context = zmq.Context()
 
+    # We handle at most this many ZMQ requests per ioloop iteration, so that
+    # the viewers keep being served while producers are busy.
+    REQUESTS_PER_ITERATION = 100
+
     def __init__(self, zmq_url=None, host="127.0.0.1", port=None,
-                 certfile=None, keyfile=None, ngrok_http_tunnel=False):
+                 certfile=None, keyfile=None, ngrok_http_tunnel=False, shm_path=None,
+                 context=None, compression_level=None, compression_min_size=DEFAULT_COMPRESSION_MIN_SIZE,
+                 telemetry_url=None, fanout_thread=True):
+        """
+        If compression_level (0-9) is given, viewers which support it get
+        their messages compressed with permessage-deflate, except for
+        messages smaller than compression_min_size bytes, such as transforms.
+
+        Besides zmq_url, the server binds a SUB socket to telemetry_url, to
+        which clients can publish transforms and properties without waiting
+        for replies. By default, it is bound next to zmq_url.
+
+        If fanout_thread is True, the web server runs on a thread of its own,
+        which writes the messages to the viewers, while this thread only
+        handles ZMQ requests and updates the scene tree. A burst of websocket
+        writes then doesn't delay the replies to the producers.
+        """
+        if context is not None:
+            self.context = context
         self.host = host
+        self.compression_level = compression_level
+        self.compression_min_size = compression_min_size
+        self.shm = ShmReader(shm_path) if shm_path is not None else None
+        # Only used on the fanout thread
         self.websocket_pool = set()
+        self.fanout_queue = collections.deque()
+        self.fanout_scheduled = False
+        self.producers = {}
+        self.ready_producers = collections.deque()
+        self.requests_scheduled = False
+        # Capture requests which have not been answered yet, by request ID
+        self.image_requests = {}
+        self.image_request_ids = itertools.count(1)
+        # Replies to capture requests which the client will collect with
+        # capture_result, by the token it chose
+        self.deferred_replies = {}
+        self.recorder = None
+        self.websocket_waiters = []
+        # Set once close has stopped the server
+        self.stopped = threading.Event()
+        self.fanout_thread = None
+        # Scene commands are all handled by handle_scene_request.
+        self.request_handlers = {
+            "url": self.handle_url_request,
+            "telemetry_url": self.handle_telemetry_url_request,
+            "wait": self.handle_wait_request,
+            "set_target": self.handle_set_target_request,
+            "capture_image": self.handle_capture_image_request,
+            "capture_result": self.handle_capture_result_request,
+            "batch": self.handle_batch_request,
+            "stats": self.handle_stats_request,
+            "start_recording": self.handle_start_recording_request,
+            "stop_recording": self.handle_stop_recording_request,
+            "get_scene": self.handle_get_scene_request,
+        }
         self.app = self.make_app()
         self.ioloop = tornado.ioloop.IOLoop.current()
 
@@ -177,6 +638,8 @@ class ZMQWebSocketBridge(object):
             (self.zmq_socket, self.zmq_stream, self.zmq_url), _ = find_available_port(f, DEFAULT_ZMQ_PORT)
         else:
             self.zmq_socket, self.zmq_stream, self.zmq_url = self.setup_zmq(zmq_url)
+        self.telemetry_socket, self.telemetry_stream, self.telemetry_url = self.setup_telemetry(telemetry_url)
+        self.telemetry_dropped = 0
 
         protocol = "http:"
         listen_kwargs = {}
@@ -191,10 +654,16 @@ class ZMQWebSocketBridge(object):
             protocol = "https:"
 
         if port is None:
-            _, self.fileserver_port = find_available_port(self.app.listen, DEFAULT_FILESERVER_PORT, **listen_kwargs)
+            sockets, self.fileserver_port = find_available_port(tornado.netutil.bind_sockets, DEFAULT_FILESERVER_PORT)
         else:
-            self.app.listen(port, **listen_kwargs)
+            sockets = tornado.netutil.bind_sockets(port)
             self.fileserver_port = port
+        self.http_server = tornado.httpserver.HTTPServer(self.app, **listen_kwargs)
+        if fanout_thread:
+            self.fanout_ioloop = self.start_fanout_thread(sockets)
+        else:
+            self.fanout_ioloop = self.ioloop
+            self.http_server.add_sockets(sockets)
         self.web_url = "{protocol}//{host}:{port}/static/".format(
             protocol=protocol, host=self.host, port=self.fileserver_port)
 
@@ -234,6 +703,55 @@ class ZMQWebSocketBridge(object):
                     raise(Exception("You must install pyngrok (e.g. via `pip install pyngrok`)."))
 
         self.tree = SceneTree()
+        self.snapshot = None
+        self.snapshot_messages = None
+        self.snapshot_build_time = None
+
+    def start_fanout_thread(self, sockets):
+        started = threading.Event()
+        result = {}
+
+        def run():
+            import asyncio
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            result["ioloop"] = tornado.ioloop.IOLoop.current()
+            self.http_server.add_sockets(sockets)
+            started.set()
+            result["ioloop"].start()
+            result["ioloop"].close()
+
+        self.fanout_thread = threading.Thread(target=run, name="meshcat-fanout", daemon=True)
+        self.fanout_thread.start()
+        started.wait()
+        return result["ioloop"]
+
+    def on_fanout(self, callback, *args):
+        """
+        Run callback on the fanout thread. Callbacks run in the order in
+        which they were posted.
+        """
+        if self.fanout_ioloop is self.ioloop:
+            callback(*args)
+            return
+        self.fanout_queue.append((callback, args))
+        if not self.fanout_scheduled:
+            self.fanout_scheduled = True
+            self.fanout_ioloop.add_callback(self.run_fanout)
+
+    def run_fanout(self):
+        # Clear the flag first, so that callbacks posted while we run are
+        # either run by us or schedule another run.
+        self.fanout_scheduled = False
+        while self.fanout_queue:
+            callback, args = self.fanout_queue.popleft()
+            callback(*args)
+
+    def on_ingestion(self, callback, *args):
+        """Run callback on the thread which handles ZMQ requests."""
+        if self.fanout_ioloop is self.ioloop:
+            callback(*args)
+        else:
+            self.ioloop.add_callback(callback, *args)
 
     def make_app(self):
         return tornado.web.Application([
@@ -241,143 +759,567 @@ class ZMQWebSocketBridge(object):
             (r"/", WebSocketHandler, {"bridge": self})
         ])
 
-    def wait_for_websockets(self):
+    def wait_for_websockets(self, callback, reply, timeout=None):
+        """
+        Call callback as soon as a viewer is connected. If none connects
+        within timeout seconds, reply with an error instead.
+        """
         if len(self.websocket_pool) > 0:
-            self.zmq_socket.send(b"ok")
-        else:
-            self.ioloop.call_later(0.1, self.wait_for_websockets)
+            callback()
+            return
+
+        def timed_out():
+            self.websocket_waiters.remove(waiter)
+            reply("error: no viewer connected within {:g} s".format(timeout).encode("utf-8"))
+
+        handle = self.ioloop.call_later(timeout, timed_out) if timeout is not None else None
+        waiter = (callback, handle)
+        self.websocket_waiters.append(waiter)
+
+    def websocket_connected(self):
+        waiters, self.websocket_waiters = self.websocket_waiters, []
+        for callback, handle in waiters:
+            if handle is not None:
+                self.ioloop.remove_timeout(handle)
+            callback()
 
-    def send_image(self, data):
-        import base64
+    def capture_image(self, data, reply, structured=False, viewer=None):
+        """
+        Ask the viewers, or only the viewer with the given ID, for an image.
+        Each request gets an ID of its own, which is sent along with it, so
+        that several requests can be answered in any order.
+        """
+        request_id = next(self.image_request_ids)
+        self.image_requests[request_id] = (reply, structured, viewer)
+        data = dict(data, request_id=request_id)
+        self.on_fanout(self.send_capture, request_id, Broadcast(codec.packb(data)), viewer)
+
+    def send_capture(self, request_id, message, viewer):
+        websockets = [websocket for websocket in self.websocket_pool if viewer is None or websocket.id == viewer]
+        if not websockets:
+            self.on_ingestion(self.fail_capture, request_id, "error: no viewer with id {}".format(viewer))
+        for websocket in websockets:
+            websocket.captures.append(request_id)
+            websocket.send(message)
+
+    def fail_capture(self, request_id, error):
+        reply, _, _ = self.image_requests.pop(request_id)
+        reply(error.encode("utf-8"))
+
+    def viewer_closed(self, viewer, request_ids):
+        # Requests for any viewer may still be answered by another one, as
+        # long as one is connected.
+        for request_id in request_ids:
+            request = self.image_requests.get(request_id)
+            if request is not None and (request[2] == viewer or not self.websocket_pool):
+                self.fail_capture(request_id, "error: viewer {} closed before sending the image".format(viewer))
+
+    def send_image(self, request_id, data):
+        """
+        Handle a capture sent by the viewer as a JSON data URL.
+        """
         mime, img_code = data.split(",", 1)
-        img_bytes = base64.b64decode(img_code)
-        self.zmq_stream.send(img_bytes)
+        image_format = "jpeg" if "jpeg" in mime else "png"
+        self.reply_image(request_id, image_format, None, None, base64.b64decode(img_code))
+
+    def receive_image(self, request_id, image):
+        """
+        Handle a capture sent by the viewer as a binary websocket frame. A
+        malformed one fails the request it answers.
+        """
+        try:
+            image_format, width, height, data = read_image(image)
+        except ValueError as e:
+            if request_id in self.image_requests:
+                self.fail_capture(request_id, "error: the viewer sent a malformed image: {}".format(e))
+            return
+        self.reply_image(request_id, image_format, width, height, data)
 
-    def handle_zmq(self, frames):
+    def reply_image(self, request_id, image_format, width, height, data):
+        # When several viewers answer a request, the first image wins.
+        request = self.image_requests.pop(request_id, None)
+        if request is None:
+            return
+        reply, structured, _ = request
+        if structured:
+            header = {u"format": image_format, u"width": width, u"height": height}
+            reply([codec.packb(header), data])
+        else:
+            reply(data)
+
+    def handle_zmq(self, frames, reply):
+        """
+        Handle one request, whose frames follow the empty delimiter frame.
+        `reply` must be called with the response, a frame or a list of frames,
+        exactly once, though not necessarily before this returns.
+        """
         cmd = frames[0].decode("utf-8")
-        if cmd == "url":
-            self.zmq_socket.send(self.web_url.encode("utf-8"))
-        elif cmd == "wait":
-            self.ioloop.add_callback(self.wait_for_websockets)
-        elif cmd == "set_target":
-            self.forward_to_websockets(frames)
-            self.zmq_socket.send(b"ok")
-        elif cmd == "capture_image":
-            if len(self.websocket_pool) > 0:
-                self.forward_to_websockets(frames)  # on_message callback should handle the pb
-            else:
-                self.ioloop.call_later(0.3, lambda: self.handle_zmq(frames))
-        elif cmd in MESHCAT_COMMANDS:
-            if len(frames) != 3:
-                self.zmq_socket.send(b"error: expected 3 frames")
+        if cmd in MESHCAT_COMMANDS:
+            self.handle_scene_request(frames, reply)
+        elif cmd in self.request_handlers:
+            self.request_handlers[cmd](frames, reply)
+        else:
+            reply(b"error: unrecognized comand")
+
+    def handle_url_request(self, frames, reply):
+        reply(self.web_url.encode("utf-8"))
+
+    def handle_telemetry_url_request(self, frames, reply):
+        reply(self.telemetry_url.encode("utf-8"))
+
+    def handle_wait_request(self, frames, reply):
+        # frames: ["wait"] or ["wait", timeout in seconds]
+        try:
+            timeout = parse_timeout(float(frames[1])) if len(frames) > 1 else None
+        except ValueError as e:
+            reply("error: expected the timeout in seconds: {}".format(e).encode("utf-8"))
+            return
+        self.wait_for_websockets(functools.partial(reply, b"ok"), reply, timeout)
+
+    def handle_set_target_request(self, frames, reply):
+        self.forward_to_websockets(frames)
+        reply(b"ok")
+
+    def handle_capture_image_request(self, frames, reply):
+        if len(frames) != 3:
+            reply(b"error: expected 3 frames")
+            return
+        try:
+            data = codec.unpackb(frames[2])
+            timeout = parse_timeout(data.get(u"timeout"))
+            image_format = data.get(u"format")
+            viewer = data.get(u"viewer")
+            deferred = data.get(u"deferred")
+            if image_format is not None and image_format not in IMAGE_FORMATS:
+                raise ValueError("unknown image format {!r}".format(image_format))
+            if deferred is not None and (not isinstance(deferred, str) or deferred in self.deferred_replies):
+                raise ValueError("deferred must be a new token, got {!r}".format(deferred))
+        except Exception as e:
+            reply("error: could not read capture_image: {!r}".format(e).encode("utf-8"))
+            return
+        if deferred is not None:
+            # The request is acknowledged right away, and the image is kept
+            # until the client asks for it with capture_result.
+            reply(b"ok")
+            reply = self.deferred_replies[deferred] = DeferredReply()
+        capture = functools.partial(self.capture_image, data, reply, image_format is not None, viewer)
+        if viewer is not None:
+            # A particular viewer must already be connected.
+            capture()
+        else:
+            self.wait_for_websockets(capture, reply, timeout)
+
+    def handle_capture_result_request(self, frames, reply):
+        # frames: ["capture_result", token]
+        token = frames[1].decode("utf-8") if len(frames) == 2 else None
+        deferred = self.deferred_replies.pop(token, None)
+        if deferred is None:
+            reply(b"error: no deferred capture_image with that token")
+            return
+        deferred.collect(reply)
+
+    def handle_scene_request(self, frames, reply):
+        if len(frames) < 3:
+            reply(b"error: expected at least 3 frames")
+            return
+        if len(frames) == 4 and frames[2] == SHM_MARKER:
+            if self.shm is None:
+                reply(b"error: shared memory is not enabled on this server")
                 return
-            path = list(filter(lambda x: len(x) > 0, frames[1].decode("utf-8").split("/")))
-            data = frames[2]
-            # Support caching of objects (note: even UUIDs have to match).
-            cache_hit = (cmd == "set_object" and
-                         find_node(self.tree, path).object and
-                         find_node(self.tree, path).object == data)
-            if not cache_hit:
-                self.forward_to_websockets(frames)
-            if cmd == "set_transform":
-                find_node(self.tree, path).transform = data
-            elif cmd == "set_object":
-                find_node(self.tree, path).object = data
-                find_node(self.tree, path).properties = []
-            elif cmd == "set_property":
-                find_node(self.tree, path).properties.append(data)
-            elif cmd == "set_animation":
-                find_node(self.tree, path).animation = data
-            elif cmd == "delete":
-                if len(path) > 0:
-                    parent = find_node(self.tree, path[:-1])
-                    child = path[-1]
-                    if child in parent:
-                        del parent[child]
-                else:
-                    self.tree = SceneTree()
-            self.zmq_socket.send(b"ok")
-        elif cmd == "get_scene":
-            # when the server gets this command, return the tree
-            # as a series of msgpack-backed binary blobs
-            drawing_commands = ""
-            for node in walk(self.tree):
-                if node.object is not None:
-                    drawing_commands += create_command(node.object)
-                for p in node.properties:
-                    drawing_commands += create_command(p)
-                if node.transform is not None:
-                    drawing_commands += create_command(node.transform)
-                if node.animation is not None:
-                    drawing_commands += create_command(node.animation)
-
-            # now that we have the drawing commands, generate the full
-            # HTML that we want to generate, including the javascript assets
-            mainminjs_path = os.path.join(VIEWER_ROOT, "main.min.js")
-            mainminjs_src = ""
-            with open(mainminjs_path, "r") as f:
-                mainminjs_src = f.readlines()
-            mainminjs_src = "".join(mainminjs_src)
-
-            html = """
-                <!DOCTYPE html>
-                <html>
-                    <head> <meta charset=utf-8> <title>MeshCat</title> </head>
-                    <body>
-                        <div id="meshcat-pane">
-                        </div>
-                        <script>
-                            {mainminjs}
-                        </script>
-                        <script>
-                            var viewer = new MeshCat.Viewer(document.getElementById("meshcat-pane"));
-                            {commands}
-                        </script>
-                         <style>
-                            body {{margin: 0; }}
-                            #meshcat-pane {{
-                                width: 100vw;
-                                height: 100vh;
-                                overflow: hidden;
-                            }}
-                        </style>
-                        <script id="embedded-json"></script>
-                    </body>
-                </html>
-            """.format(mainminjs=mainminjs_src, commands=drawing_commands)
-            self.zmq_socket.send(html.encode('utf-8'))
+            frames = frames[:2] + [self.shm.read(frames[3])]
+        elif len(frames) > 3:
+            # Large arrays arrive as frames of their own, which together
+            # with the rest make up the msgpack-encoded data.
+            frames = frames[:2] + [b"".join(frames[2:])]
+        try:
+            commands = self.parse_scene_command(frames)
+        except ValueError as e:
+            reply("error: {}".format(e).encode("utf-8"))
+            return
+        for command in commands:
+            self.apply_scene_command(*command)
+        reply(b"ok")
+
+    def handle_batch_request(self, frames, reply):
+        # frames: ["batch", "", type, path, data, type, path, data, ...]
+        commands = [frames[i:i + 3] for i in range(2, len(frames), 3)]
+        if not commands or len(commands[-1]) != 3:
+            reply(b"error: expected 3 frames per batched command")
+            return
+        if any(c[0].decode("utf-8") not in BATCH_COMMANDS for c in commands):
+            reply(b"error: unsupported command in batch")
+            return
+        # Check the whole batch first, so that a malformed command
+        # doesn't leave the batch half applied.
+        try:
+            commands = [c for command in commands for c in self.parse_scene_command(command)]
+        except ValueError as e:
+            reply("error: {}".format(e).encode("utf-8"))
+            return
+        for command in commands:
+            self.apply_scene_command(*command)
+        reply(b"ok")
+
+    def handle_stats_request(self, frames, reply):
+        self.on_fanout(self.send_stats, reply)
+
+    def handle_start_recording_request(self, frames, reply):
+        # frames: ["start_recording", "", data]
+        if len(frames) != 3:
+            reply(b"error: expected 3 frames")
+            return
+        if self.recorder is not None:
+            reply(b"error: already recording")
+            return
+        try:
+            self.recorder = self.make_recorder(codec.unpackb(frames[2]))
+        except Exception as e:
+            reply("error: could not start recording: {}".format(e).encode("utf-8"))
+            return
+        self.recorder.start()
+        reply(b"ok")
+
+    def handle_stop_recording_request(self, frames, reply):
+        if self.recorder is None:
+            reply(b"error: not recording")
+            return
+        recorder, self.recorder = self.recorder, None
+        self.ioloop.add_future(recorder.stop(), functools.partial(self.send_recording_stats, reply, recorder))
+
+    def handle_get_scene_request(self, frames, reply):
+        # Generating the HTML for a large scene takes a while, so do it
+        # on a worker thread and reply once it's done.
+        future = self.ioloop.run_in_executor(None, static_html, self.scene_snapshot())
+        self.ioloop.add_future(future, functools.partial(self.send_static_html, reply))
+
+    def make_recorder(self, data):
+        fps = data.get(u"fps", DEFAULT_RECORDING_FPS)
+        if not fps > 0:
+            raise ValueError("fps must be positive, got {!r}".format(fps))
+        request = {key: data[key] for key in [u"xres", u"yres", u"viewer"] if key in data}
+        request[u"type"] = u"capture_image"
+        request[u"format"] = data.get(u"format", u"png")
+        if request[u"format"] not in IMAGE_FORMATS:
+            raise ValueError("unknown image format {!r}".format(request[u"format"]))
+        if u"publish_url" in data:
+            sink = PublishSink(self.context, data[u"publish_url"])
+        elif u"filename" in data:
+            sink = FfmpegSink(data[u"filename"], fps)
+        else:
+            raise ValueError("either a filename or a publish_url is required")
+        return Recorder(self, sink, fps, request)
+
+    def send_recording_stats(self, reply, recorder, future):
+        try:
+            status = future.result()
+        except Exception as e:
+            status = e
+        if status != 0:
+            reply("error: ffmpeg failed: {}".format(status).encode("utf-8"))
+            return
+        reply(json.dumps(recorder.stats()).encode("utf-8"))
+
+    def send_stats(self, reply):
+        stats = [websocket.stats() for websocket in self.websocket_pool]
+        self.on_ingestion(reply, json.dumps(stats).encode("utf-8"))
+
+    def send_static_html(self, reply, future):
+        try:
+            html = future.result()
+        except Exception as e:
+            reply("error: could not generate static HTML: {}".format(e).encode("utf-8"))
+            return
+        reply(html.encode("utf-8"))
+
+    def handle_scene_command(self, frames):
+        for command in self.parse_scene_command(frames):
+            self.apply_scene_command(*command)
+
+    def parse_scene_command(self, frames):
+        """
+        Check a scene command and return the (cmd, path, frames, key) of each
+        command it expands to, without changing anything yet. Raises
+        ValueError if the command is malformed.
+        """
+        cmd = frames[0].decode("utf-8")
+        if cmd == "set_target":
+            return [(cmd, None, frames, None)]
+        if cmd == "set_transforms":
+            commands = []
+            for command in split_set_transforms(frames[2]):
+                commands.extend(self.parse_scene_command(command))
+            return commands
+        path = self.tree.parse_path(frames[1])
+        # A transform or property which hasn't reached a slow viewer yet is
+        # superseded by the next one for the same path.
+        if cmd == "set_transform":
+            key = (cmd, path)
+        elif cmd == "set_property":
+            try:
+                prop = codec.unpackb(frames[2])[u"property"]
+            except Exception as e:
+                raise ValueError("could not read the property of set_property: {!r}".format(e))
+            key = (cmd, path, prop)
+        else:
+            key = None
+        return [(cmd, path, frames, key)]
+
+    def apply_scene_command(self, cmd, path, frames, key):
+        if cmd == "set_target":
+            self.forward_to_websockets(frames)
+            return
+        data = frames[2]
+        # Support caching of objects (note: even UUIDs have to match).
+        if cmd == "set_object":
+            node = self.tree.find(path)
+            cache_hit = node is not None and node.object == data
         else:
-            self.zmq_socket.send(b"error: unrecognized comand")
+            cache_hit = False
+        if not cache_hit:
+            self.forward_to_websockets(frames, key)
+        self.snapshot = None
+        self.snapshot_messages = None
+        if cmd == "set_transform":
+            self.tree.get(path).transform = data
+        elif cmd == "set_object":
+            node = self.tree.get(path)
+            node.object = data
+            node.properties = {}
+        elif cmd == "set_property":
+            self.tree.get(path).properties[key[2]] = data
+        elif cmd == "set_animation":
+            self.tree.get(path).animation = data
+        elif cmd == "delete":
+            if len(path) > 0:
+                self.tree.delete(path)
+            else:
+                self.tree = SceneTree()
 
-    def forward_to_websockets(self, frames):
+    def forward_to_websockets(self, frames, key=None):
         cmd, path, data = frames
+        self.on_fanout(self.broadcast, Broadcast(data), key)
+
+    def broadcast(self, message, key):
         for websocket in self.websocket_pool:
-            websocket.write_message(data, binary=True)
+            websocket.send(message, key)
 
     def setup_zmq(self, url):
-        zmq_socket = self.context.socket(zmq.REP)
+        # A ROUTER socket lets many producers (REQ or DEALER sockets) talk to
+        # us at once. Each message starts with the routing envelope of its
+        # producer, which we send back with the reply.
+        zmq_socket = self.context.socket(zmq.ROUTER)
         zmq_socket.bind(url)
         zmq_stream = ZMQStream(zmq_socket)
-        zmq_stream.on_recv(self.handle_zmq)
+        zmq_stream.on_recv(self.receive_zmq)
         return zmq_socket, zmq_stream, url
 
+    def setup_telemetry(self, url):
+        telemetry_socket = self.context.socket(zmq.SUB)
+        telemetry_socket.setsockopt(zmq.SUBSCRIBE, b"")
+        if url is not None:
+            telemetry_socket.bind(url)
+        elif self.zmq_url.startswith("tcp://"):
+            host = self.zmq_url[len("tcp://"):].rsplit(":", 1)[0]
+            port = telemetry_socket.bind_to_random_port("tcp://" + host)
+            url = "tcp://{:s}:{:d}".format(host, port)
+        else:
+            url = self.zmq_url + "-telemetry"
+            telemetry_socket.bind(url)
+        telemetry_stream = ZMQStream(telemetry_socket)
+        telemetry_stream.on_recv(self.receive_telemetry)
+        return telemetry_socket, telemetry_stream, url
+
+    def receive_telemetry(self, frames):
+        """
+        Apply a command from the telemetry socket. Nobody is waiting for a
+        reply, so malformed commands are only counted in telemetry_dropped.
+        """
+        if len(frames) < 3 or frames[0].decode("utf-8", "replace") not in TELEMETRY_COMMANDS:
+            self.telemetry_dropped += 1
+            return
+        if len(frames) > 3:
+            frames = frames[:2] + [b"".join(frames[2:])]
+        try:
+            commands = self.parse_scene_command(frames)
+        except ValueError:
+            self.telemetry_dropped += 1
+            return
+        for command in commands:
+            self.apply_scene_command(*command)
+
+    def receive_zmq(self, msg):
+        try:
+            delimiter = msg.index(b"")
+        except ValueError:
+            # Not a REQ or DEALER message, so there is nobody to reply to.
+            return
+        envelope = tuple(msg[:delimiter + 1])
+        producer = self.producers.get(envelope)
+        if producer is None:
+            producer = self.producers[envelope] = Producer(self, envelope)
+        producer.requests.append(msg[delimiter + 1:])
+        if not producer.busy and len(producer.requests) == 1:
+            self.ready_producers.append(producer)
+            self.schedule_requests()
+
+    def schedule_requests(self):
+        if not self.requests_scheduled:
+            self.requests_scheduled = True
+            self.ioloop.add_callback(self.handle_requests)
+
+    def handle_requests(self):
+        """
+        Handle queued requests one at a time from each producer in turn, so
+        that a producer sending a flood of requests, or a huge one, can't
+        starve the others. Each producer's requests are handled, and replied
+        to, in order.
+        """
+        self.requests_scheduled = False
+        for _ in range(self.REQUESTS_PER_ITERATION):
+            if not self.ready_producers:
+                return
+            producer = self.ready_producers.popleft()
+            producer.busy = True
+            try:
+                self.handle_zmq(producer.requests.popleft(), producer.reply)
+            except Exception as e:
+                # Answer the request which failed, so that the producer can
+                # carry on and its next requests get handled.
+                print("error handling request from {}: {!r}".format(producer.envelope, e), file=sys.stderr)
+                if producer.busy:
+                    producer.reply("error: {!r}".format(e).encode("utf-8"))
+        if self.ready_producers:
+            self.schedule_requests()
+
+    def send_reply(self, producer, data):
+        frames = data if isinstance(data, list) else [data]
+        self.zmq_stream.send_multipart(list(producer.envelope) + frames)
+        producer.busy = False
+        if producer.requests:
+            self.ready_producers.append(producer)
+            self.schedule_requests()
+        else:
+            del self.producers[producer.envelope]
+
+    def scene_snapshot(self):
+        """
+        Return the list of messages which bring a new viewer up to date with
+        the scene. The list is only rebuilt after the scene has changed, so
+        viewers which connect at the same time share one snapshot.
+        """
+        if self.snapshot is None:
+            start = time.time()
+            snapshot = []
+            for node in self.tree.walk():
+                if node.object is not None:
+                    snapshot.append(node.object)
+                snapshot.extend(node.properties.values())
+                if node.transform is not None:
+                    snapshot.append(node.transform)
+                if node.animation is not None:
+                    snapshot.append(node.animation)
+            self.snapshot = snapshot
+            self.snapshot_build_time = time.time() - start
+        return self.snapshot
+
     def send_scene(self, websocket):
-        for node in walk(self.tree):
-            if node.object is not None:
-                websocket.write_message(node.object, binary=True)
-            for p in node.properties:
-                websocket.write_message(p, binary=True)
-            if node.transform is not None:
-                websocket.write_message(node.transform, binary=True)
-            if node.animation is not None:
-                websocket.write_message(node.animation, binary=True)
+        # Viewers which connect at the same time share the compressed
+        # messages, too.
+        if self.snapshot_messages is None:
+            self.snapshot_messages = [Broadcast(data) for data in self.scene_snapshot()]
+        self.on_fanout(self.add_websocket, websocket, self.snapshot_messages)
+
+    def add_websocket(self, websocket, messages):
+        # The viewer only joins the pool along with the snapshot, so that it
+        # gets exactly the messages which were forwarded after the snapshot.
+        if websocket.ws_connection is None:
+            return
+        self.websocket_pool.add(websocket)
+        websocket.send_scene(messages)
+        self.on_ingestion(self.websocket_connected)
 
     def run(self):
         self.ioloop.start()
 
+    def close(self):
+        """
+        Stop the server, from any thread: disconnect the viewers, stop
+        listening, close the ZMQ sockets and stop the ioloops, after which
+        `run` returns. When the server runs on another thread, blocks until
+        it has stopped.
+        """
+        self.ioloop.add_callback(self.stop)
+        if tornado.ioloop.IOLoop.current(instance=False) is not self.ioloop:
+            self.stopped.wait()
+            if self.fanout_thread is not None:
+                self.fanout_thread.join()
 
-def main():
+    def stop(self):
+        if self.recorder is not None:
+            self.recorder.stop()
+            self.recorder = None
+        self.zmq_stream.close(linger=0)
+        self.telemetry_stream.close(linger=0)
+        if self.fanout_ioloop is self.ioloop:
+            self.stop_fanout()
+        else:
+            self.fanout_ioloop.add_callback(self.stop_fanout)
+
+    def stop_fanout(self):
+        self.http_server.stop()
+        for websocket in list(self.websocket_pool):
+            websocket.close()
+        if self.fanout_ioloop is not self.ioloop:
+            self.fanout_ioloop.stop()
+        self.on_ingestion(self.stop_ioloop)
+
+    def stop_ioloop(self):
+        self.ioloop.stop()
+        self.stopped.set()
+
+
+def server_arg_parser():
     import argparse
+    parser = argparse.ArgumentParser(description="Serve the MeshCat HTML files and listen for ZeroMQ commands")
+    parser.add_argument('--zmq-url', '-z', type=str, nargs="?", default=None)
+    parser.add_argument('--open', '-o', action="store_true")
+    parser.add_argument('--certfile', type=str, default=None)
+    parser.add_argument('--keyfile', type=str, default=None)
+    parser.add_argument('--shm-path', type=str, default=None, help="""
+Read command data from this shared-memory ring buffer. This is set up
+automatically by clients which start the server themselves.""")
+    parser.add_argument('--telemetry-url', type=str, default=None, help="""
+Bind the SUB socket, to which clients can publish transforms and properties
+without waiting for replies, to this URL. By default it is bound next to the
+ZMQ URL. Clients can ask the server for it with the "telemetry_url" command.""")
+    parser.add_argument('--no-fanout-thread', dest="fanout_thread", action="store_false", help="""
+Serve the viewers on the same thread as the ZMQ socket, instead of a thread
+of their own.""")
+    parser.add_argument('--compression-level', type=int, default=None, choices=range(10), help="""
+Compress messages to the viewers with permessage-deflate at this zlib level.
+Each message is compressed once, however many viewers there are.""")
+    parser.add_argument('--compression-min-size', type=int, default=DEFAULT_COMPRESSION_MIN_SIZE, help="""
+Send messages smaller than this many bytes uncompressed.""")
+    parser.add_argument('--ngrok_http_tunnel', action="store_true", help="""
+ngrok is a service for creating a public URL from your local machine, which
+is very useful if you would like to make your meshcat server public.""")
+    return parser
+
+
+def bridge_from_args(results, **kwargs):
+    return ZMQWebSocketBridge(zmq_url=results.zmq_url,
+                              certfile=results.certfile,
+                              keyfile=results.keyfile,
+                              ngrok_http_tunnel=results.ngrok_http_tunnel,
+                              shm_path=results.shm_path,
+                              compression_level=results.compression_level,
+                              compression_min_size=results.compression_min_size,
+                              telemetry_url=results.telemetry_url,
+                              fanout_thread=results.fanout_thread,
+                              **kwargs)
+
+
+def main():
     import sys
     import webbrowser
     import platform
@@ -388,19 +1330,8 @@ def main():
     if sys.version_info >= (3, 8) and platform.system() == 'Windows':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-    parser = argparse.ArgumentParser(description="Serve the MeshCat HTML files and listen for ZeroMQ commands")
-    parser.add_argument('--zmq-url', '-z', type=str, nargs="?", default=None)
-    parser.add_argument('--open', '-o', action="store_true")
-    parser.add_argument('--certfile', type=str, default=None)
-    parser.add_argument('--keyfile', type=str, default=None)
-    parser.add_argument('--ngrok_http_tunnel', action="store_true", help="""
-ngrok is a service for creating a public URL from your local machine, which
-is very useful if you would like to make your meshcat server public.""")
-    results = parser.parse_args()
-    bridge = ZMQWebSocketBridge(zmq_url=results.zmq_url,
-                                certfile=results.certfile,
-                                keyfile=results.keyfile,
-                                ngrok_http_tunnel=results.ngrok_http_tunnel)
+    results = server_arg_parser().parse_args()
+    bridge = bridge_from_args(results)
     print("zmq_url={:s}".format(bridge.zmq_url))
     print("web_url={:s}".format(bridge.web_url))
     if results.open:
@@ -0,0 +1,38 @@
+"""
+A stand-in for ffmpeg, which copies its stdin to the output file (its last
+argument) and saves its arguments next to it, so that the tests don't need
+ffmpeg to be installed.
+"""
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import os
+import shutil
+import stat
+import sys
+import tempfile
+from unittest import mock
+
+
+@contextlib.contextmanager
+def installed():
+    """Put the fake ffmpeg first on the PATH."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "ffmpeg")
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\nexec '{}' '{}' \"$@\"\n".format(sys.executable, os.path.abspath(__file__)))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        with mock.patch.dict(os.environ, {"PATH": tmp_dir + os.pathsep + os.environ["PATH"]}):
+            yield
+
+
+def main():
+    output_path = sys.argv[-1]
+    with open(output_path + ".args", "w") as f:
+        f.write("\n".join(sys.argv[1:]))
+    with open(output_path, "wb") as f:
+        shutil.copyfileobj(sys.stdin.buffer, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import unittest
+
+import numpy as np
+
+import meshcat.transformations as tf
+from meshcat.animation import Animation, AnimationTrack, convert_frames_to_video
+from meshcat.path import Path
+from meshcat.tests import fake_ffmpeg
+
+
+class FakeVisualizer(object):
+    def __init__(self, *path):
+        self.path = Path(path)
+
+
+class TestAnimationTrack(unittest.TestCase):
+    def test_order(self):
+        track = AnimationTrack("opacity", "number")
+        for frame, value in [(3, 1), (1, 0.5), (2, 2), (1, 7)]:
+            track.set_property(frame, value)
+        track.set_properties([0, 5, 4], [0, 5, 4])
+        np.testing.assert_array_equal(track.frames, [0, 1, 1, 2, 3, 4, 5])
+        # Keyframes at the same frame stay in order, and ints are promoted
+        np.testing.assert_array_equal(track.values, [0, 0.5, 7, 2, 1, 4, 5])
+
+    def test_lower(self):
+        track = AnimationTrack("position", "vector3")
+        track.set_property(2, [4, 5, 6])
+        track.set_property(1, [1, 2, 3])
+        self.assertEqual(track.lower(), {
+            u"name": ".position", u"type": "vector3",
+            u"keys": [{u"time": 1, u"value": [1, 2, 3]}, {u"time": 2, u"value": [4, 5, 6]}]})
+        data = track.lower(columnar=True)
+        self.assertEqual((data[u"name"], data[u"type"]), (".position", "vector3"))
+        self.assertEqual(data[u"times"].type, 0x17)
+        self.assertEqual(data[u"times"].data, np.array([1, 2], dtype=np.float32).tobytes())
+        self.assertEqual(data[u"values"].data, np.arange(1, 7, dtype=np.float32).tobytes())
+
+        track = AnimationTrack("visible", "boolean")
+        track.set_properties([0, 1], [True, False])
+        self.assertEqual(track.lower(columnar=True)[u"values"], [True, False])
+        self.assertEqual([key[u"value"] for key in track.lower()[u"keys"]], [True, False])
+
+    def test_growth(self):
+        track = AnimationTrack("position", "vector3")
+        for i in reversed(range(1000)):
+            track.set_property(i, [i, 0, 0])
+        np.testing.assert_array_equal(track.frames, np.arange(1000))
+        np.testing.assert_array_equal(track.values[:, 0], np.arange(1000))
+        with self.assertRaises(ValueError):
+            track.set_properties([1, 2], [[0, 0, 0]])
+
+    def test_read_only(self):
+        track = AnimationTrack("opacity", "number", [0, 1], [0.5, 1.0])
+        with self.assertRaises(ValueError):
+            track.frames[0] = 2
+        with self.assertRaises(ValueError):
+            track.values[0] = 2
+        track.set_property(2, 0.0)
+        np.testing.assert_array_equal(track.values, [0.5, 1, 0])
+
+    def test_bools_and_numbers(self):
+        track = AnimationTrack("visible", "boolean")
+        track.set_property(0, True)
+        track.set_property(1, False)
+        for value in [1, 0.5, [1.0]]:
+            with self.assertRaises(ValueError):
+                track.set_property(2, value)
+        with self.assertRaises(ValueError):
+            track.set_properties([2, 3], [1, 0])
+        track = AnimationTrack("opacity", "number")
+        track.set_property(0, 0.5)
+        with self.assertRaises(ValueError):
+            track.set_property(1, True)
+        np.testing.assert_array_equal(track.frames, [0])
+
+
+class TestSetTrajectory(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that set_trajectory gives the same tracks as setting the
+        transform at each frame.
+        """
+        matrices = np.array([tf.random_rotation_matrix() for _ in range(50)])
+        matrices[:, :3, 3] = np.random.rand(50, 3)
+        frames = np.arange(50) * 2
+        vis = FakeVisualizer("meshcat", "box")
+
+        expected = Animation()
+        for frame, matrix in zip(frames, matrices):
+            with expected.at_frame(vis, frame) as frame_vis:
+                frame_vis.set_transform(matrix)
+        animation = Animation()
+        animation.set_trajectory(vis, frames, matrices)
+
+        for track, expected_track in zip(animation.lower(columnar=True)[0][u"clip"][u"tracks"],
+                                         expected.lower(columnar=True)[0][u"clip"][u"tracks"]):
+            self.assertEqual(track[u"name"], expected_track[u"name"])
+            self.assertEqual(track[u"times"].data, expected_track[u"times"].data)
+            np.testing.assert_allclose(track[u"values"].array, expected_track[u"values"].array, atol=1e-6)
+
+
+@unittest.skipIf(sys.platform == "win32", "the fake ffmpeg is a shell script")
+class TestConvertFramesToVideo(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that the frames are streamed into ffmpeg in order, without
+        being extracted.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tar_path = os.path.join(tmp_dir, "frames.tar")
+            with tarfile.open(tar_path, "w") as tar:
+                for i in [2, 0, 1]:
+                    data = "frame {:d};".format(i).encode("utf-8")
+                    info = tarfile.TarInfo("{:07d}.png".format(i))
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+            output_path = os.path.join(tmp_dir, "output.mp4")
+            with fake_ffmpeg.installed():
+                convert_frames_to_video(tar_path, output_path, framerate=24)
+            with open(output_path, "rb") as f:
+                self.assertEqual(f.read(), b"frame 0;frame 1;frame 2;")
+            with open(output_path + ".args") as f:
+                args = f.read().split("\n")
+            self.assertEqual(args[:6], ["-r", "24", "-f", "image2pipe", "-i", "-"])
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["frames.tar", "output.mp4", "output.mp4.args"])
@@ -0,0 +1,65 @@
+import unittest
+
+import numpy as np
+import umsgpack
+
+import meshcat.geometry as g
+import meshcat.transformations as tf
+from meshcat.codec import UmsgpackCodec, MsgpackCodec, packb, packb_frames
+from meshcat.commands import SetObject, SetTransform, SetProperty
+from meshcat.path import Path
+
+
+class TestCodecs(unittest.TestCase):
+    """
+    Test that every available msgpack backend produces the same bytes.
+    """
+    def setUp(self):
+        self.codecs = [UmsgpackCodec()]
+        try:
+            self.codecs.append(MsgpackCodec())
+        except ImportError:
+            pass
+
+    def test_commands(self):
+        path = Path(("meshcat", "test"))
+        verts = np.random.rand(3, 100).astype(np.float32)
+        commands = [
+            SetTransform(tf.translation_matrix([1, 2, 3]), path),
+            SetProperty("visible", False, path),
+            SetObject(g.Box([1, 2, 3]), path=path),
+            SetObject(g.PointCloud(verts, verts), path=path),
+        ]
+        for cmd in commands:
+            data = cmd.lower()
+            expected = umsgpack.packb(data)
+            for codec in self.codecs:
+                packed = codec.packb(data)
+                self.assertEqual(packed, expected, codec.name)
+                self.assertEqual(codec.unpackb(packed), umsgpack.unpackb(expected))
+
+    def test_set_transform_fast_path(self):
+        for path in [Path(("meshcat", "test")), Path(("a" * 40,)), Path(("b" * 300,))]:
+            for matrix in [tf.random_rotation_matrix(), np.eye(4, dtype=np.float32)]:
+                cmd = SetTransform(matrix, path)
+                for codec in self.codecs:
+                    self.assertEqual(cmd.packb(), codec.packb(cmd.lower()))
+
+
+class TestOutOfBandFrames(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that splitting large arrays into frames of their own produces
+        the same bytes once the frames are joined back together.
+        """
+        path = Path(("meshcat", "test"))
+        verts = np.random.rand(3, 100000)
+        colors = np.random.rand(3, 10).astype(np.float32)
+        data = SetObject(g.PointCloud(verts, colors), path=path).lower()
+        frames = packb_frames(data)
+        self.assertEqual(len(frames), 3)
+        self.assertIsInstance(frames[1], memoryview)
+        self.assertEqual(frames[1].nbytes, verts.size * 4)
+        self.assertEqual(b"".join(frames), packb(data))
+        self.assertEqual(b"".join(frames), umsgpack.packb(data))
+        self.assertEqual(packb_frames(data, min_size=2**32), [packb(data)])
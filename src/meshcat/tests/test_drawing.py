@@ -3,21 +3,27 @@ import subprocess
 import sys
 import tempfile
 import os
+import time
 
 from io import StringIO, BytesIO
 
 import io
 
 import numpy as np
+import umsgpack
 
 import meshcat
 import meshcat.geometry as g
 import meshcat.transformations as tf
+from meshcat.commands import SetTransforms
+from meshcat.servers.zmqserver import split_set_transforms
 
 
 class VisualizerTest(unittest.TestCase):
+    visualizer_kwargs = {}
+
     def setUp(self):
-        self.vis = meshcat.Visualizer()
+        self.vis = meshcat.Visualizer(**self.visualizer_kwargs)
 
         if "CI" in os.environ:
             port = self.vis.url().split(":")[-1].split("/")[0]
@@ -243,6 +249,8 @@ class TestStaticHTML(TestDrawing):
 class TestSetProperty(VisualizerTest):
     def runTest(self):
         self.vis["/Background"].set_property("top_color", [1, 0, 0])
+        self.vis["/Cameras/default/rotated/<object>"].set_property("position", np.array([1., 2., 3.]))
+        self.vis.set_cam_pos([1, 2, 3])
 
 
 class TestTriangularMesh(VisualizerTest):
@@ -300,3 +308,141 @@ class TestPerspectiveCamera(VisualizerTest):
             tf.translation_matrix([1, -1, 0.5]))
         self.vis['/Cameras/default/rotated/<object>'].set_property(
             "position", [0, 0, 0])
+
+
+class TestPipelinedCommands(VisualizerTest):
+    def runTest(self):
+        """
+        Test that commands can be pipelined and then flushed.
+        """
+        self.vis.window.max_pending = 16
+        v = self.vis["pipelined"]
+        v["box"].set_object(g.Box([0.1, 0.2, 0.3]))
+        for i in range(100):
+            v["box"].set_transform(tf.translation_matrix([0.01 * i, 0, 0]))
+        self.assertLess(len(self.vis.window.pending), 16)
+        self.vis.flush()
+        self.assertEqual(len(self.vis.window.pending), 0)
+        # Requests which expect a reply are serialized behind pending commands
+        v["box"].set_transform(tf.translation_matrix([1, 0, 0]))
+        self.assertIn("static", self.vis.window.request_web_url())
+
+
+class TestBatch(VisualizerTest):
+    def runTest(self):
+        """
+        Test that commands sent inside a batch reach the server as one message.
+        """
+        v = self.vis["batch"]
+        with self.vis.batch():
+            for i in range(10):
+                v[str(i)].set_object(g.Box([0.1, 0.1, 0.1]))
+                v[str(i)].set_transform(tf.translation_matrix([0.2 * i, 0, 0]))
+                v[str(i)].set_property("visible", True)
+            v["0"].delete()
+            self.assertEqual(len(self.vis.window.batch_frames), 3 * 31)
+        self.assertIsNone(self.vis.window.batch_frames)
+
+        with self.assertRaises(ZeroDivisionError):
+            with self.vis.batch():
+                v["1"].delete()
+                1 / 0
+        self.assertIsNone(self.vis.window.batch_frames)
+
+
+class TestSetTransforms(VisualizerTest):
+    def runTest(self):
+        """
+        Test that many transforms can be set with a single command.
+        """
+        v = self.vis["bulk"]
+        paths = ["link_{:d}".format(i) for i in range(20)]
+        for p in paths:
+            v[p].set_object(g.Box([0.1, 0.1, 0.1]))
+        matrices = np.array([tf.translation_matrix([0.2 * i, 0, 0]) for i in range(len(paths))])
+        v.set_transforms(paths, matrices)
+
+        with self.assertRaises(ValueError):
+            v.set_transforms(paths[:-1], matrices)
+
+        cmd = SetTransforms(matrices, [v.path.append(p) for p in paths])
+        commands = list(split_set_transforms(umsgpack.packb(cmd.lower())))
+        self.assertEqual(len(commands), len(paths))
+        self.assertEqual(commands[3][1], b"/meshcat/bulk/link_3")
+        matrix = np.frombuffer(umsgpack.unpackb(commands[3][2])["matrix"].data, dtype=np.float32)
+        np.testing.assert_allclose(matrix, matrices[3].T.flatten())
+
+
+class TestLargePointCloud(VisualizerTest):
+    def runTest(self):
+        """
+        Test that a point cloud large enough to be sent as out-of-band frames
+        reaches the server.
+        """
+        verts = np.random.rand(3, 200000).astype(np.float32)
+        self.vis["points"].set_object(g.PointCloud(verts, verts))
+        self.vis["points"].set_object(g.PointCloud(verts.astype(np.float64), verts))
+
+
+class TestSharedMemory(VisualizerTest):
+    visualizer_kwargs = {"shared_memory": True, "max_pending": 8}
+
+    def runTest(self):
+        """
+        Test that command data can be sent through shared memory.
+        """
+        self.assertIsNotNone(self.vis.window.shm)
+        verts = np.random.rand(3, 200000).astype(np.float32)
+        self.vis["points"].set_object(g.PointCloud(verts, verts))
+        for i in range(100):
+            self.vis["points"].set_transform(tf.translation_matrix([0.01 * i, 0, 0]))
+        self.vis.flush()
+        self.assertEqual(len(self.vis.window.shm.regions), 0)
+
+        shm_path = self.vis.window.shm.path
+        self.vis.close()
+        self.assertFalse(os.path.exists(shm_path))
+        self.assertIsNone(self.vis.window.shm)
+
+        with self.assertRaises(ValueError):
+            meshcat.Visualizer(shared_memory=True, in_process_server=True)
+
+
+class TestInProcessServer(VisualizerTest):
+    visualizer_kwargs = {"in_process_server": True}
+
+    def runTest(self):
+        """
+        Test that the server can run on a thread of this process.
+        """
+        self.assertIsNone(self.vis.window.server_proc)
+        self.assertTrue(self.vis.window.zmq_url.startswith("inproc://"))
+        v = self.vis["shapes"]
+        v["cube"].set_object(g.Box([0.1, 0.2, 0.3]))
+        v.set_transform(tf.translation_matrix([1., 0, 0]))
+        bridge = self.vis.window.server
+        self.vis.close()
+        self.assertTrue(bridge.stopped.is_set())
+        self.assertIsNone(self.vis.window.server)
+
+
+class TestTelemetry(VisualizerTest):
+    visualizer_kwargs = {"in_process_server": True}
+
+    def runTest(self):
+        """
+        Test that transforms and properties can be published without waiting
+        for acknowledgments.
+        """
+        bridge = self.vis.window.server
+        v = self.vis["telemetry"]
+        deadline = time.time() + 5
+        # The first messages may be lost while the PUB socket connects
+        while bridge.tree.find(("meshcat", "telemetry")) is None and time.time() < deadline:
+            v.publish_transform(tf.translation_matrix([1., 0, 0]))
+            v.publish_property("visible", False)
+            v.publish_transforms(["a", "b"], np.array([np.eye(4), np.eye(4)]))
+            time.sleep(0.01)
+        node = bridge.tree.find(("meshcat", "telemetry"))
+        self.assertIsNotNone(node)
+        self.assertIsNotNone(node.transform)
@@ -0,0 +1,103 @@
+import unittest
+
+import numpy as np
+
+import meshcat.geometry as g
+from meshcat.codec import packb
+from meshcat.commands import SetObject
+from meshcat.path import Path
+
+
+class TestContentAddressedUUIDs(unittest.TestCase):
+    """
+    Test that content-addressed elements lower to identical commands.
+    """
+    def setUp(self):
+        g.SceneElement.content_addressed = True
+
+    def tearDown(self):
+        g.SceneElement.content_addressed = False
+
+    def lower(self, obj):
+        return packb(SetObject(obj, path=Path(("meshcat", "test"))).lower())
+
+    def test_identical_objects(self):
+        def make_mesh():
+            return g.Mesh(g.Box([1, 2, 3]), g.MeshLambertMaterial(
+                map=g.ImageTexture(image=g.PngImage(b"not really a png"))))
+
+        self.assertEqual(self.lower(make_mesh()), self.lower(make_mesh()))
+
+        verts = np.random.rand(3, 100).astype(np.float32)
+        self.assertEqual(self.lower(g.PointCloud(verts, verts)),
+                         self.lower(g.PointCloud(verts.copy(), verts.copy())))
+
+    def test_different_objects(self):
+        self.assertNotEqual(self.lower(g.Mesh(g.Box([1, 2, 3]))),
+                            self.lower(g.Mesh(g.Box([1, 2, 4]))))
+        self.assertNotEqual(self.lower(g.Mesh(g.Box([1, 2, 3]), g.MeshLambertMaterial(color=0xff0000))),
+                            self.lower(g.Mesh(g.Box([1, 2, 3]), g.MeshLambertMaterial(color=0x00ff00))))
+
+    def test_opt_in(self):
+        g.SceneElement.content_addressed = False
+        self.assertNotEqual(self.lower(g.Mesh(g.Box([1, 2, 3]))),
+                            self.lower(g.Mesh(g.Box([1, 2, 3]))))
+        box = g.Box([1, 2, 3])
+        box.content_addressed = True
+        data = g.Mesh(box).lower()
+        self.assertEqual(data[u"geometries"][0][u"uuid"], g.Mesh(box).lower()[u"object"][u"geometry"])
+        self.assertNotEqual(data[u"geometries"][0][u"uuid"], box.uuid)
+
+
+class TestLoweringCache(unittest.TestCase):
+    """
+    Test that lowered elements are cached until they change.
+    """
+    def assertCacheCounts(self, f, hits, misses):
+        before = (g.SceneElement.cache_hits, g.SceneElement.cache_misses)
+        result = f()
+        self.assertEqual((g.SceneElement.cache_hits - before[0], g.SceneElement.cache_misses - before[1]),
+                         (hits, misses))
+        return result
+
+    def test_cache(self):
+        image = g.PngImage(b"not really a png")
+        material = g.MeshLambertMaterial(map=g.ImageTexture(image=image))
+        verts = np.random.rand(3, 100).astype(np.float32)
+        geometry = g.PointsGeometry(verts)
+        obj = g.Mesh(geometry, material)
+
+        # object, geometry, material, texture, image
+        first = self.assertCacheCounts(obj.lower, 0, 5)
+        second = self.assertCacheCounts(obj.lower, 1, 0)
+        self.assertIs(first, second)
+
+        # Reusing the geometry in another object only lowers the new object
+        other = g.Points(geometry, g.PointsMaterial())
+        self.assertCacheCounts(other.lower, 1, 2)
+
+        # Changing a nested element invalidates everything that refers to it
+        image.data = b"a different png"
+        changed = self.assertCacheCounts(obj.lower, 1, 4)
+        self.assertEqual(changed[u"images"][0][u"url"], g.PngImage(b"a different png").lower({})[u"url"])
+        self.assertCacheCounts(other.lower, 1, 0)
+
+        verts[0, 0] = 2
+        self.assertCacheCounts(obj.lower, 1, 0)
+        geometry.invalidate()
+        self.assertCacheCounts(obj.lower, 1, 2)
+
+
+class TestPackTypedArray(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that only 1-D and Fortran-ordered arrays are packed without a
+        copy, and that all arrays are flattened in column-major order.
+        """
+        vertices = np.arange(12, dtype=np.float32).reshape(4, 3)
+        for x, copied in [(vertices[:, 0].copy(), False),
+                          (np.asfortranarray(vertices), False),
+                          (vertices, True)]:
+            ext = g.pack_typed_array(x)
+            self.assertEqual(np.shares_memory(ext.array, x), not copied)
+            np.testing.assert_array_equal(ext.array, x.ravel(order='F'))
@@ -0,0 +1,55 @@
+import os
+import unittest
+
+from meshcat.servers.shm import ShmWriter, ShmReader, pack_descriptor
+
+
+class TestShmRing(unittest.TestCase):
+    """
+    Test allocation in the shared-memory ring buffer.
+    """
+    def setUp(self):
+        self.writer = ShmWriter(size=100)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def test_allocate(self):
+        w = self.writer
+        self.assertEqual(w.allocate(40), 0)
+        self.assertEqual(w.allocate(40), 40)
+        # Not enough room at the end, and the start is still in use
+        self.assertIsNone(w.allocate(30))
+        w.release()
+        # Wrap around to the start
+        self.assertEqual(w.allocate(30), 0)
+        self.assertIsNone(w.allocate(20))
+        w.release()
+        self.assertEqual(w.allocate(20), 30)
+        w.release()
+        w.release()
+        self.assertEqual(w.allocate(100), 0)
+        self.assertIsNone(w.allocate(1))
+        w.release()
+        self.assertIsNone(w.allocate(101))
+
+    def test_read_write(self):
+        w = self.writer
+        offset = w.allocate(11)
+        w.write(offset, [b"hello", memoryview(b" world")])
+        reader = ShmReader(w.path)
+        self.assertEqual(reader.read(pack_descriptor(offset, 11)), b"hello world")
+        with self.assertRaises(ValueError):
+            reader.read(pack_descriptor(95, 10))
+
+    def test_release_file(self):
+        path = self.writer.path
+        self.writer.close()
+        self.assertFalse(os.path.exists(path))
+        # Closing twice is harmless
+        self.writer.close()
+
+        writer = ShmWriter(size=100)
+        path = writer.path
+        del writer
+        self.assertFalse(os.path.exists(path))
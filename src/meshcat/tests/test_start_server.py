@@ -1,6 +1,6 @@
 import unittest
 
-from meshcat.servers.zmqserver import start_zmq_server_as_subprocess
+from meshcat.servers.zmqserver import start_zmq_server_as_subprocess, start_zmq_server_as_thread
 
 class TestStartZmqServer(unittest.TestCase):
     """
@@ -15,3 +15,23 @@ class TestStartZmqServer(unittest.TestCase):
         proc, zmq_url, web_url = start_zmq_server_as_subprocess( server_args=["--ngrok_http_tunnel"])
         self.assertIsNotNone(web_url)
         self.assertNotIn("127.0.0.1", web_url)
+
+
+class TestStartZmqServerAsThread(unittest.TestCase):
+    """
+    Test the start_zmq_server_as_thread method.
+    """
+
+    def test_close(self):
+        import socket
+        bridge, zmq_url, web_url = start_zmq_server_as_thread()
+        bridge.close()
+        self.assertTrue(bridge.stopped.is_set())
+        self.assertFalse(bridge.fanout_thread.is_alive())
+        with self.assertRaises(ConnectionRefusedError):
+            socket.create_connection(("127.0.0.1", bridge.fileserver_port)).close()
+        self.assertTrue(bridge.zmq_stream.closed())
+
+    def test_invalid_args(self):
+        with self.assertRaises(ValueError):
+            start_zmq_server_as_thread(server_args=["--compression-level", "10"])
@@ -0,0 +1,40 @@
+import unittest
+
+from meshcat.servers.tree import SceneTree
+
+
+class TestSceneTree(unittest.TestCase):
+    def setUp(self):
+        self.tree = SceneTree()
+
+    def test_parse_path(self):
+        self.assertEqual(self.tree.parse_path(b"/meshcat/robot//link"), ("meshcat", "robot", "link"))
+        self.assertEqual(self.tree.parse_path("/meshcat/robot"), ("meshcat", "robot"))
+        self.assertEqual(self.tree.parse_path(b""), ())
+        self.assertIs(self.tree.parse_path(b"/a/b"), self.tree.parse_path(b"/a/b"))
+
+    def test_find_does_not_create(self):
+        self.assertIsNone(self.tree.find(("a", "b")))
+        self.assertEqual(list(self.tree.walk()), [self.tree.root])
+
+    def test_get_and_delete(self):
+        node = self.tree.get(("a", "b", "c"))
+        node.transform = b"transform"
+        self.assertIs(self.tree.find(("a", "b", "c")), node)
+        self.assertIsNotNone(self.tree.find(("a", "b")))
+        self.tree.get(("a", "d"))
+
+        self.tree.delete(("a", "b"))
+        self.assertIsNone(self.tree.find(("a", "b")))
+        self.assertIsNone(self.tree.find(("a", "b", "c")))
+        self.assertIsNotNone(self.tree.find(("a", "d")))
+        self.assertEqual(set(self.tree.index.keys()), {(), ("a",), ("a", "d")})
+        # Deleting something which doesn't exist is a no-op
+        self.tree.delete(("x", "y"))
+        self.assertIsNone(self.tree.find(("x",)))
+
+    def test_walk_order(self):
+        for path in [("a",), ("a", "b"), ("c",), ("a", "d")]:
+            self.tree.get(path).object = path
+        objects = [n.object for n in self.tree.walk() if n.object is not None]
+        self.assertEqual(objects, [("a",), ("a", "b"), ("a", "d"), ("c",)])
@@ -0,0 +1,716 @@
+import base64
+import json
+import re
+import struct
+import sys
+import unittest
+import zlib
+from unittest import mock
+
+import numpy as np
+import tornado.concurrent
+import tornado.gen
+import tornado.httputil
+import umsgpack
+
+import meshcat.geometry as g
+from meshcat.codec import packb, unpackb
+from meshcat.commands import SetObject, SetTransform, SetProperty, Delete, CaptureImage
+from meshcat.path import Path
+from meshcat.servers.zmqserver import ZMQWebSocketBridge, WebSocketHandler, Broadcast, static_html
+
+
+class TestBridgeProperties(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that the server only keeps the latest value of each property.
+        """
+        bridge = ZMQWebSocketBridge(zmq_url="inproc://meshcat-test-properties", fanout_thread=False)
+        path = Path(("meshcat", "box"))
+        for i in range(100):
+            for key in ["visible", "opacity"]:
+                cmd = SetProperty(key, i, path).lower()
+                bridge.handle_scene_command([b"set_property", path.lower().encode("utf-8"), packb(cmd)])
+        node = bridge.tree.find(("meshcat", "box"))
+        self.assertEqual(list(node.properties.keys()), ["visible", "opacity"])
+        self.assertEqual(unpackb(node.properties["opacity"])[u"value"], 99)
+
+
+class TestBridgeSnapshot(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that the scene snapshot sent to new viewers is reused until the
+        scene changes.
+        """
+        bridge = ZMQWebSocketBridge(zmq_url="inproc://meshcat-test-snapshot", fanout_thread=False)
+        path = Path(("meshcat", "box"))
+
+        def send(cmd):
+            data = cmd.lower()
+            bridge.handle_scene_command([data[u"type"].encode("utf-8"), data[u"path"].encode("utf-8"), packb(data)])
+
+        send(SetObject(g.Box([1, 2, 3]), path=path))
+        send(SetTransform(np.eye(4), path))
+        send(SetProperty("visible", False, path))
+        snapshot = bridge.scene_snapshot()
+        self.assertEqual([unpackb(m)[u"type"] for m in snapshot], ["set_object", "set_property", "set_transform"])
+        self.assertIs(bridge.scene_snapshot(), snapshot)
+        self.assertIsNotNone(bridge.snapshot_build_time)
+
+        send(Delete(path))
+        self.assertEqual(bridge.scene_snapshot(), [])
+
+
+class TestStaticHTMLBlob(unittest.TestCase):
+    @mock.patch("meshcat.servers.zmqserver.viewer_js_src", return_value="// viewer")
+    def runTest(self, viewer_js_src):
+        """
+        Test that the static HTML embeds the scene as one length-prefixed blob.
+        """
+        snapshot = [b"first", b"", b"third message"]
+        html = static_html(snapshot)
+        self.assertIn("// viewer", html)
+        blob = base64.b64decode(re.search(r"base64,([^\"]*)\"", html).group(1))
+        messages = []
+        offset = 0
+        while offset < len(blob):
+            (length,) = struct.unpack_from("<I", blob, offset)
+            messages.append(blob[offset + 4:offset + 4 + length])
+            offset += 4 + length
+        self.assertEqual(messages, snapshot)
+
+
+class SlowWebSocket(WebSocketHandler):
+    """
+    A websocket whose writes stay pending until `flush` is called.
+    """
+    def __init__(self, bridge):
+        connection = mock.Mock(context=mock.Mock(remote_ip="127.0.0.1"))
+        request = tornado.httputil.HTTPServerRequest(method="GET", uri="/", connection=connection)
+        super(SlowWebSocket, self).__init__(bridge.app, request, bridge=bridge)
+        self.written = []
+        self.pending = None
+        self.closed = False
+
+    def write_frame(self, message):
+        self.written.append(message.data)
+        self.pending = tornado.concurrent.Future()
+        return self.pending
+
+    def close(self, code=None, reason=None):
+        self.closed = True
+
+    def flush(self):
+        self.pending.set_result(None)
+        self.on_write_done(self.pending)
+
+
+class TestWebSocketCoalescing(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that queued transforms and properties for a slow viewer are
+        superseded by newer ones, while other commands are all delivered.
+        """
+        bridge = ZMQWebSocketBridge(zmq_url="inproc://meshcat-test-coalescing", fanout_thread=False)
+        websocket = SlowWebSocket(bridge)
+        bridge.websocket_pool.add(websocket)
+        path = Path(("meshcat", "box"))
+
+        def send(cmd):
+            data = cmd.lower()
+            bridge.handle_scene_command([data[u"type"].encode("utf-8"), data[u"path"].encode("utf-8"), packb(data)])
+
+        send(SetObject(g.Box([1, 2, 3]), path=path))
+        for i in range(10):
+            send(SetTransform(np.eye(4) * i, path))
+            send(SetProperty("visible", i % 2 == 0, path))
+            send(SetProperty("opacity", i, path))
+        send(Delete(path))
+        self.assertEqual(websocket.stats(), {"id": websocket.id, "remote_ip": "127.0.0.1",
+                                             "queued": 4, "dropped": 27, "overflowed": False})
+
+        while websocket.queue:
+            websocket.flush()
+        messages = [unpackb(m) for m in websocket.written]
+        self.assertEqual([m[u"type"] for m in messages],
+                         ["set_object", "set_transform", "set_property", "set_property", "delete"])
+        self.assertEqual(messages[3][u"value"], 9)
+
+
+class TestWebSocketOverflow(unittest.TestCase):
+    @mock.patch.object(WebSocketHandler, "MAX_QUEUE_SIZE", 10)
+    def runTest(self):
+        """
+        Test that a viewer which falls too far behind is disconnected instead
+        of queueing messages without bound.
+        """
+        bridge = ZMQWebSocketBridge(zmq_url="inproc://meshcat-test-overflow", fanout_thread=False)
+        websocket = SlowWebSocket(bridge)
+        bridge.websocket_pool.add(websocket)
+        for i in range(20):
+            cmd = SetObject(g.Box([1, 2, 3]), path=Path(("meshcat", str(i)))).lower()
+            bridge.handle_scene_command([b"set_object", cmd[u"path"].encode("utf-8"), packb(cmd)])
+        self.assertTrue(websocket.closed)
+        self.assertEqual(websocket.stats()["queued"], 0)
+        self.assertTrue(websocket.stats()["overflowed"])
+        self.assertEqual(len(websocket.written), 1)
+
+
+class TestLargeSceneSync(unittest.TestCase):
+    @mock.patch.object(WebSocketHandler, "MAX_QUEUE_SIZE", 10)
+    def runTest(self):
+        """
+        Test that a viewer which connects to a scene with more messages than
+        MAX_QUEUE_SIZE is not disconnected by the next broadcast.
+        """
+        bridge = ZMQWebSocketBridge(zmq_url="inproc://meshcat-test-large-scene", fanout_thread=False)
+        for i in range(20):
+            cmd = SetObject(g.Box([1, 2, 3]), path=Path(("meshcat", str(i)))).lower()
+            bridge.handle_scene_command([b"set_object", cmd[u"path"].encode("utf-8"), packb(cmd)])
+        websocket = SlowWebSocket(bridge)
+        bridge.websocket_pool.add(websocket)
+        websocket.send_scene([Broadcast(data) for data in bridge.scene_snapshot()])
+        cmd = SetTransform(np.eye(4), Path(("meshcat", "0"))).lower()
+        bridge.handle_scene_command([b"set_transform", cmd[u"path"].encode("utf-8"), packb(cmd)])
+        self.assertFalse(websocket.closed)
+        self.assertFalse(websocket.stats()["overflowed"])
+
+        while websocket.queue:
+            websocket.flush()
+        self.assertEqual(len(websocket.written), 21)
+        self.assertEqual(websocket.syncing, 0)
+
+
+class TestMalformedCommands(unittest.TestCase):
+    def setUp(self):
+        self.bridge = ZMQWebSocketBridge(zmq_url="inproc://" + self.id(), fanout_thread=False)
+        self.send_reply = mock.Mock()
+        self.websocket = SlowWebSocket(self.bridge)
+        self.bridge.websocket_pool.add(self.websocket)
+
+    def reply(self):
+        return self.send_reply.call_args[0][0]
+
+    def test_set_property_without_property(self):
+        data = packb({u"type": u"set_property", u"path": u"/meshcat/box", u"value": 1})
+        self.bridge.handle_zmq([b"set_property", b"/meshcat/box", data], self.send_reply)
+        self.assertTrue(self.reply().startswith(b"error"))
+        self.bridge.handle_zmq([b"set_property", b"/meshcat/box", b"\xc1"], self.send_reply)
+        self.assertTrue(self.reply().startswith(b"error"))
+        self.assertIsNone(self.bridge.tree.find(("meshcat", "box")))
+
+    def test_batch_is_checked_before_it_is_applied(self):
+        path = Path(("meshcat", "box"))
+        good = SetTransform(np.eye(4), path).lower()
+        bad = {u"type": u"set_property", u"path": path.lower(), u"value": 1}
+        frames = [b"batch", b""]
+        for cmd in [good, bad]:
+            frames.extend([cmd[u"type"].encode("utf-8"), cmd[u"path"].encode("utf-8"), packb(cmd)])
+        self.bridge.handle_zmq(frames, self.send_reply)
+        self.assertTrue(self.reply().startswith(b"error"))
+        self.assertIsNone(self.bridge.tree.find(("meshcat", "box")))
+        self.assertEqual(self.websocket.written, [])
+
+    def test_malformed_set_transforms(self):
+        paths = [u"/meshcat/a", u"/meshcat/b"]
+        for cmd in [{u"type": u"set_transforms", u"path": u"", u"paths": paths},
+                    {u"type": u"set_transforms", u"path": u"", u"paths": paths,
+                     u"matrices": umsgpack.Ext(0x17, b"\0" * 100)}]:
+            self.bridge.handle_zmq([b"set_transforms", b"", packb(cmd)], self.send_reply)
+            self.assertTrue(self.reply().startswith(b"error"))
+        self.assertIsNone(self.bridge.tree.find(("meshcat", "a")))
+
+
+class TestSharedCompression(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that a broadcast is compressed once for all viewers, and that
+        small messages bypass compression.
+        """
+        bridge = ZMQWebSocketBridge(zmq_url="inproc://meshcat-test-compression", compression_level=6,
+                                    fanout_thread=False)
+        connections = []
+        for _ in range(3):
+            connection = mock.Mock(_compressor=mock.Mock(_max_wbits=15), RSV1=0x40)
+            connection.is_closing.return_value = False
+            websocket = SlowWebSocket(bridge)
+            websocket.ws_connection = connection
+            connections.append(connection)
+            self.assertEqual(websocket.get_compression_options(), {"compression_level": 6})
+            bridge.websocket_pool.add(websocket)
+
+        large = Broadcast(b"meshcat " * 1000)
+        small = Broadcast(b"transform")
+        for websocket in bridge.websocket_pool:
+            WebSocketHandler.write_frame(websocket, large)
+            WebSocketHandler.write_frame(websocket, small)
+        payloads = []
+        for connection in connections:
+            (fin, opcode, payload), kwargs = connection._write_frame.call_args_list[0]
+            self.assertEqual(kwargs, {"flags": 0x40})
+            payloads.append(payload)
+            self.assertEqual(connection._write_frame.call_args_list[1], mock.call(True, 0x2, b"transform"))
+        self.assertIs(payloads[0], payloads[1])
+        self.assertIs(payloads[0], payloads[2])
+        decompressor = zlib.decompressobj(-15)
+        self.assertEqual(decompressor.decompress(payloads[0] + b"\x00\x00\xff\xff"), large.data)
+
+
+class TestTelemetry(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that commands from the telemetry socket are applied like any
+        other, and that malformed ones are dropped.
+        """
+        bridge = ZMQWebSocketBridge(zmq_url="inproc://meshcat-test-telemetry", fanout_thread=False)
+        self.assertEqual(bridge.telemetry_url, "inproc://meshcat-test-telemetry-telemetry")
+        path = Path(("meshcat", "box"))
+        cmd = SetTransform(np.eye(4), path).lower()
+        bridge.receive_telemetry([b"set_transform", b"/meshcat/box", packb(cmd)])
+        self.assertIsNotNone(bridge.tree.find(("meshcat", "box")).transform)
+        bridge.receive_telemetry([b"delete", b"/meshcat/box", packb(Delete(path).lower())])
+        bridge.receive_telemetry([b"set_property", b"/meshcat/box", b"\xc1"])
+        self.assertEqual(bridge.telemetry_dropped, 2)
+        self.assertIsNotNone(bridge.tree.find(("meshcat", "box")))
+
+
+class TestTelemetryURL(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that a telemetry URL with a wildcard host is connected to at the
+        host which the client reaches the server at.
+        """
+        from meshcat.visualizer import connect_url
+        for url, zmq_url, expected in [
+                ("tcp://*:6001", "tcp://127.0.0.1:6000", "tcp://127.0.0.1:6001"),
+                ("tcp://0.0.0.0:6001", "tcp://robot.local:6000", "tcp://robot.local:6001"),
+                ("tcp://*:6001", "tcp://*:6000", "tcp://127.0.0.1:6001"),
+                ("tcp://10.0.0.2:6001", "tcp://127.0.0.1:6000", "tcp://10.0.0.2:6001"),
+                ("inproc://meshcat-telemetry", "inproc://meshcat", "inproc://meshcat-telemetry")]:
+            self.assertEqual(connect_url(url, zmq_url), expected)
+
+
+class TestWaitForViewer(unittest.TestCase):
+    def setUp(self):
+        self.bridge = ZMQWebSocketBridge(zmq_url="inproc://" + self.id(), fanout_thread=False)
+        self.reply = mock.Mock()
+
+    def connect(self):
+        websocket = SlowWebSocket(self.bridge)
+        websocket.ws_connection = mock.Mock()
+        self.bridge.add_websocket(websocket, [])
+        return websocket
+
+    def test_wait(self):
+        self.bridge.handle_zmq([b"wait"], self.reply)
+        self.bridge.handle_zmq([b"wait", b"100"], self.reply)
+        self.reply.assert_not_called()
+        self.connect()
+        self.assertEqual(self.reply.call_args_list, [mock.call(b"ok"), mock.call(b"ok")])
+        self.bridge.handle_zmq([b"wait"], self.reply)
+        self.assertEqual(self.reply.call_count, 3)
+
+    def test_timeout(self):
+        self.bridge.handle_zmq([b"wait", b"0.01"], self.reply)
+        self.bridge.ioloop.run_sync(lambda: tornado.gen.sleep(0.05))
+        self.reply.assert_called_once()
+        self.assertTrue(self.reply.call_args[0][0].startswith(b"error"))
+        self.assertEqual(self.bridge.websocket_waiters, [])
+
+    def test_invalid_timeout(self):
+        for timeout in [b"soon", b"-1", b"nan", b"inf"]:
+            self.reply.reset_mock()
+            self.bridge.handle_zmq([b"wait", timeout], self.reply)
+            self.reply.assert_called_once()
+            self.assertTrue(self.reply.call_args[0][0].startswith(b"error"))
+        for timeout in [u"soon", -1, True, [1]]:
+            self.reply.reset_mock()
+            cmd = dict(CaptureImage().lower(), timeout=timeout)
+            self.bridge.handle_zmq([b"capture_image", b"", packb(cmd)], self.reply)
+            self.reply.assert_called_once()
+            self.assertTrue(self.reply.call_args[0][0].startswith(b"error"))
+        self.assertEqual(self.bridge.websocket_waiters, [])
+
+    def data_url(self, mime, data):
+        return json.dumps({"data": "data:{:s};base64,{:s}".format(mime, base64.b64encode(data).decode("utf-8"))})
+
+    def test_capture_image(self):
+        cmd = CaptureImage(64, 48).lower()
+        self.bridge.handle_zmq([b"capture_image", b"", packb(cmd)], self.reply)
+        websocket = self.connect()
+        self.assertEqual([unpackb(m)[u"type"] for m in websocket.written], ["capture_image"])
+        websocket.on_message(self.data_url("image/png", b"png"))
+        self.reply.assert_called_once_with(b"png")
+
+    def test_capture_image_formats(self):
+        websocket = self.connect()
+        self.bridge.handle_zmq([b"capture_image", b"", packb(CaptureImage(2, 1, format="rgba").lower())], self.reply)
+        websocket.on_message(packb({u"type": u"image", u"format": u"rgba", u"width": 2, u"height": 1,
+                                    u"data": b"\x01" * 8}))
+        header, data = self.reply.call_args[0][0]
+        self.assertEqual(unpackb(header), {u"format": u"rgba", u"width": 2, u"height": 1})
+        self.assertEqual(data, b"\x01" * 8)
+
+        # A viewer which only sends data URLs still answers with its file
+        self.bridge.handle_zmq([b"capture_image", b"", packb(CaptureImage(format="rgba").lower())], self.reply)
+        websocket.on_message(self.data_url("image/jpeg", b"jpeg"))
+        header, data = self.reply.call_args[0][0]
+        self.assertEqual(unpackb(header), {u"format": u"jpeg", u"width": None, u"height": None})
+        self.assertEqual(data, b"jpeg")
+
+        self.bridge.handle_zmq([b"capture_image", b"", packb(CaptureImage(format="tiff").lower())], self.reply)
+        self.assertTrue(self.reply.call_args[0][0].startswith(b"error"))
+
+    def test_malformed_binary_capture(self):
+        websocket = self.connect()
+        image = {u"type": u"image", u"format": u"rgba", u"width": 2, u"height": 1, u"data": b"\x01" * 8}
+        for key, value in [(u"width", None), (u"height", None), (u"data", None),
+                           (u"data", b"\x01" * 7), (u"format", u"tiff")]:
+            self.reply.reset_mock()
+            cmd = CaptureImage(2, 1, format="rgba").lower()
+            self.bridge.handle_zmq([b"capture_image", b"", packb(cmd)], self.reply)
+            malformed = dict(image)
+            if value is None:
+                del malformed[key]
+            else:
+                malformed[key] = value
+            websocket.on_message(packb(malformed))
+            self.reply.assert_called_once()
+            self.assertTrue(self.reply.call_args[0][0].startswith(b"error"))
+        self.assertEqual(self.bridge.image_requests, {})
+        self.assertEqual(list(websocket.captures), [])
+
+    def test_concurrent_captures(self):
+        first, second = self.connect(), self.connect()
+        replies = [mock.Mock() for _ in range(3)]
+        for reply in replies[:2]:
+            self.bridge.handle_zmq([b"capture_image", b"", packb(CaptureImage().lower())], reply)
+        cmd = CaptureImage(viewer=second.id).lower()
+        self.bridge.handle_zmq([b"capture_image", b"", packb(cmd)], replies[2])
+        self.assertEqual(list(first.captures), [1, 2])
+        self.assertEqual(list(second.captures), [1, 2, 3])
+        self.assertEqual(unpackb(second.written[0])[u"request_id"], 1)
+
+        # Viewers may answer in any order, and the first answer wins
+        second.on_message(json.dumps(dict(json.loads(self.data_url("image/png", b"3")), request_id=3)))
+        second.on_message(json.dumps(dict(json.loads(self.data_url("image/png", b"2")), request_id=2)))
+        first.on_message(self.data_url("image/png", b"1"))
+        first.on_message(self.data_url("image/png", b"too late"))
+        self.assertEqual([r.call_args_list for r in replies],
+                         [[mock.call(b"1")], [mock.call(b"2")], [mock.call(b"3")]])
+        self.assertEqual(self.bridge.image_requests, {})
+        self.assertEqual(list(second.captures), [1])
+
+    def test_untargeted_viewer_closes(self):
+        first, second = self.connect(), self.connect()
+        self.bridge.handle_zmq([b"capture_image", b"", packb(CaptureImage().lower())], self.reply)
+        first.on_close()
+        self.reply.assert_not_called()
+        second.on_close()
+        self.assertTrue(self.reply.call_args[0][0].startswith(b"error"))
+
+    def test_targeted_viewer_closes(self):
+        websocket = self.connect()
+        cmd = CaptureImage(viewer=websocket.id).lower()
+        self.bridge.handle_zmq([b"capture_image", b"", packb(cmd)], self.reply)
+        websocket.on_close()
+        self.assertTrue(self.reply.call_args[0][0].startswith(b"error"))
+        cmd = CaptureImage(viewer=websocket.id).lower()
+        self.bridge.handle_zmq([b"capture_image", b"", packb(cmd)], self.reply)
+        self.assertEqual(self.reply.call_count, 2)
+        self.assertTrue(self.reply.call_args[0][0].startswith(b"error"))
+        self.assertEqual(self.bridge.image_requests, {})
+
+    def test_deferred_captures(self):
+        websocket = self.connect()
+        for token in [u"early", u"late"]:
+            cmd = CaptureImage(deferred=token).lower()
+            self.bridge.handle_zmq([b"capture_image", b"", packb(cmd)], self.reply)
+        self.assertEqual(self.reply.call_args_list, [mock.call(b"ok"), mock.call(b"ok")])
+        self.bridge.handle_zmq([b"capture_image", b"", packb(CaptureImage(deferred=u"late").lower())], self.reply)
+        self.assertTrue(self.reply.call_args[0][0].startswith(b"error"))
+
+        # The image may arrive before or after it is asked for.
+        websocket.on_message(self.data_url("image/png", b"early"))
+        collected = [mock.Mock() for _ in range(2)]
+        self.bridge.handle_zmq([b"capture_result", b"early"], collected[0])
+        self.bridge.handle_zmq([b"capture_result", b"late"], collected[1])
+        collected[1].assert_not_called()
+        websocket.on_message(self.data_url("image/png", b"late"))
+        self.assertEqual([c.call_args_list for c in collected], [[mock.call(b"early")], [mock.call(b"late")]])
+        self.assertEqual(self.bridge.deferred_replies, {})
+
+        self.reply.reset_mock()
+        self.bridge.handle_zmq([b"capture_result", b"early"], self.reply)
+        self.assertTrue(self.reply.call_args[0][0].startswith(b"error"))
+
+
+class TestRouterScheduling(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that requests from several producers are handled in turn, and
+        that each reply goes back to the producer which sent the request.
+        """
+        bridge = ZMQWebSocketBridge(zmq_url="inproc://meshcat-test-router", fanout_thread=False)
+        bridge.zmq_stream = mock.Mock()
+        handled = []
+
+        def handle_zmq(frames, reply):
+            handled.append(frames[0])
+            reply(frames[0] + b" done")
+
+        bridge.handle_zmq = handle_zmq
+        for i in range(4):
+            bridge.receive_zmq([b"mesh", b"", "mesh {:d}".format(i).encode("utf-8")])
+        for i in range(2):
+            bridge.receive_zmq([b"pose", b"", "pose {:d}".format(i).encode("utf-8")])
+        bridge.handle_requests()
+        self.assertEqual(handled, [b"mesh 0", b"pose 0", b"mesh 1", b"pose 1", b"mesh 2", b"mesh 3"])
+        replies = [c[0][0] for c in bridge.zmq_stream.send_multipart.call_args_list]
+        self.assertEqual(replies[:2], [[b"mesh", b"", b"mesh 0 done"], [b"pose", b"", b"pose 0 done"]])
+        self.assertEqual(bridge.producers, {})
+
+
+class TestFailingRequests(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that a request whose handler raises gets an error reply, and that
+        the producer's later requests and other producers are still served.
+        """
+        bridge = ZMQWebSocketBridge(zmq_url="inproc://meshcat-test-failing", fanout_thread=False)
+        bridge.zmq_stream = mock.Mock()
+        capture = packb({u"type": u"capture_image", u"timeout": u"soon"})
+        bridge.receive_zmq([b"bad", b"", b"\xff"])
+        bridge.receive_zmq([b"bad", b"", b"capture_image", b"", capture])
+        bridge.receive_zmq([b"bad", b"", b"url"])
+        bridge.receive_zmq([b"good", b"", b"url"])
+        bridge.handle_requests()
+        replies = {}
+        for call in bridge.zmq_stream.send_multipart.call_args_list:
+            frames = call[0][0]
+            replies.setdefault(frames[0], []).append(frames[2])
+        self.assertEqual(len(replies[b"bad"]), 3)
+        self.assertTrue(replies[b"bad"][0].startswith(b"error"))
+        self.assertTrue(replies[b"bad"][1].startswith(b"error"))
+        self.assertEqual(replies[b"bad"][2], bridge.web_url.encode("utf-8"))
+        self.assertEqual(replies[b"good"], [bridge.web_url.encode("utf-8")])
+        self.assertEqual(bridge.producers, {})
+
+
+class TestConcurrentProducers(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that a producer waiting for a reply doesn't block other
+        producers.
+        """
+        import zmq
+        from meshcat.servers.zmqserver import start_zmq_server_as_thread
+        context = zmq.Context()
+        bridge, zmq_url, web_url = start_zmq_server_as_thread(context=context)
+        waiting = context.socket(zmq.REQ)
+        waiting.connect(zmq_url)
+        # Nobody will ever open the viewer, so this never gets a reply
+        waiting.send(b"wait")
+        other = context.socket(zmq.REQ)
+        other.connect(zmq_url)
+        other.send(b"url")
+        self.assertTrue(other.poll(5000))
+        self.assertEqual(other.recv().decode("utf-8"), web_url)
+        self.assertFalse(waiting.poll(100))
+        waiting.close(linger=0)
+        other.close(linger=0)
+
+
+class TestFanoutThread(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that a viewer served from the fanout thread gets the scene and
+        then every later message, in order.
+        """
+        import asyncio
+        import tornado.websocket
+        from meshcat.servers.zmqserver import start_zmq_server_as_thread
+        from meshcat.visualizer import ViewerWindow, Visualizer
+        bridge, zmq_url, web_url = start_zmq_server_as_thread(context=ViewerWindow.context)
+        self.assertIsNot(bridge.fanout_ioloop, bridge.ioloop)
+        vis = Visualizer(zmq_url=zmq_url)
+        vis["box"].set_object(g.Box([1, 2, 3]))
+
+        async def view():
+            websocket = await tornado.websocket.websocket_connect(
+                "ws://127.0.0.1:{:d}/".format(bridge.fileserver_port))
+            messages = [await websocket.read_message()]
+            for i in range(3):
+                vis["box"].set_property("opacity", i)
+                messages.append(await websocket.read_message())
+            self.assertEqual(len(vis.stats()), 1)
+            websocket.close()
+            return [unpackb(m) for m in messages]
+
+        messages = asyncio.run(asyncio.wait_for(view(), 10))
+        self.assertEqual([m[u"type"] for m in messages], ["set_object"] + ["set_property"] * 3)
+        self.assertEqual([m[u"value"] for m in messages[1:]], [0, 1, 2])
+        vis.close()
+
+
+class TestCaptureImageArray(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that raw pixels sent by the viewer as a binary frame arrive as
+        NumPy arrays, and that concurrent captures get their own images.
+        """
+        import asyncio
+        import tornado.websocket
+        from meshcat.servers.zmqserver import start_zmq_server_as_thread
+        from meshcat.visualizer import ViewerWindow, Visualizer
+        bridge, zmq_url, web_url = start_zmq_server_as_thread(context=ViewerWindow.context)
+        vis = Visualizer(zmq_url=zmq_url)
+        sizes = [(2, 3), (5, 1)]
+
+        def pixels(w, h):
+            return np.arange(h * w * 4, dtype=np.uint8).reshape(h, w, 4)
+
+        async def view():
+            websocket = await tornado.websocket.websocket_connect(
+                "ws://127.0.0.1:{:d}/".format(bridge.fileserver_port))
+            requests = [unpackb(await websocket.read_message()) for _ in sizes]
+            self.assertEqual([r[u"format"] for r in requests], [u"rgba", u"rgba"])
+            for request in reversed(requests):
+                w, h = request[u"xres"], request[u"yres"]
+                await websocket.write_message(packb({
+                    u"type": u"image", u"request_id": request[u"request_id"], u"format": u"rgba",
+                    u"width": w, u"height": h, u"data": pixels(w, h).tobytes()}), binary=True)
+
+        async def capture():
+            futures = [asyncio.wrap_future(vis.get_image_future(w, h)) for w, h in sizes]
+            await view()
+            return [await future for future in futures]
+
+        images = asyncio.run(asyncio.wait_for(capture(), 10))
+        for image, (w, h) in zip(images, sizes):
+            np.testing.assert_array_equal(image, pixels(w, h))
+        vis.close()
+
+
+class TestCaptureImageOrder(unittest.TestCase):
+    def runTest(self):
+        """
+        Test that get_image_future captures the scene as it was when it was
+        called, even though the image is waited for on another thread.
+        """
+        import asyncio
+        import tornado.websocket
+        from meshcat.servers.zmqserver import start_zmq_server_as_thread
+        from meshcat.visualizer import ViewerWindow, Visualizer
+        bridge, zmq_url, web_url = start_zmq_server_as_thread(context=ViewerWindow.context)
+        vis = Visualizer(zmq_url=zmq_url, max_pending=4)
+
+        async def view():
+            websocket = await tornado.websocket.websocket_connect(
+                "ws://127.0.0.1:{:d}/".format(bridge.fileserver_port))
+            vis.wait()
+            vis["box"].set_transform(np.eye(4))
+            future = vis.get_image_future(1, 1)
+            vis["box"].set_transform(2 * np.eye(4))
+            vis.flush()
+            messages = [unpackb(await websocket.read_message()) for _ in range(3)]
+            self.assertEqual([m[u"type"] for m in messages], ["set_transform", "capture_image", "set_transform"])
+            await websocket.write_message(packb({
+                u"type": u"image", u"request_id": messages[1][u"request_id"], u"format": u"rgba",
+                u"width": 1, u"height": 1, u"data": b"\0\0\0\xff"}), binary=True)
+            return await asyncio.wrap_future(future)
+
+        image = asyncio.run(asyncio.wait_for(view(), 10))
+        self.assertEqual(image.shape, (1, 1, 4))
+        vis.close()
+
+
+class TestRecording(unittest.TestCase):
+    def setUp(self):
+        from meshcat.servers.zmqserver import start_zmq_server_as_thread
+        from meshcat.visualizer import ViewerWindow, Visualizer
+        self.context = ViewerWindow.context
+        self.bridge, zmq_url, web_url = start_zmq_server_as_thread(context=self.context)
+        self.vis = Visualizer(zmq_url=zmq_url)
+
+    def tearDown(self):
+        self.vis.close()
+
+    def pixels(self, i):
+        return np.full((3, 2, 4), i, dtype=np.uint8)
+
+    def view(self, frames, on_frame):
+        """
+        Answer capture requests with raw pixels from a viewer, until
+        on_frame(i) has returned True for `frames` of them.
+        """
+        import asyncio
+        import tornado.websocket
+
+        async def view():
+            websocket = await tornado.websocket.websocket_connect(
+                "ws://127.0.0.1:{:d}/".format(self.bridge.fileserver_port))
+            received = 0
+            i = 0
+            while received < frames:
+                request = unpackb(await websocket.read_message())
+                self.assertEqual(request[u"type"], u"capture_image")
+                await websocket.write_message(packb({
+                    u"type": u"image", u"request_id": request[u"request_id"], u"format": u"rgba",
+                    u"width": 2, u"height": 3, u"data": self.pixels(i).tobytes()}), binary=True)
+                received += await asyncio.get_running_loop().run_in_executor(None, on_frame, i)
+                i += 1
+            websocket.close()
+
+        asyncio.run(asyncio.wait_for(view(), 10))
+
+    def test_publish(self):
+        import zmq
+        url = "inproc://" + self.id()
+        self.vis.start_recording(fps=100, format="rgba", publish_url=url)
+        subscriber = self.context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b"")
+        subscriber.connect(url)
+        received = []
+
+        def on_frame(i):
+            # Frames published before the subscription took effect are lost
+            if not subscriber.poll(1000):
+                return False
+            header, data = subscriber.recv_multipart()
+            received.append((unpackb(header), data))
+            return True
+
+        self.view(3, on_frame)
+        stats = self.vis.stop_recording()
+        subscriber.close(linger=0)
+        self.assertGreaterEqual(stats["frames"], 3)
+        self.assertEqual(len(received), 3)
+        for header, data in received:
+            self.assertEqual((header[u"format"], header[u"width"], header[u"height"]), (u"rgba", 2, 3))
+            self.assertEqual(data, self.pixels(header[u"frame"]).tobytes())
+
+    @unittest.skipIf(sys.platform == "win32", "the fake ffmpeg is a shell script")
+    def test_ffmpeg(self):
+        import os
+        import tempfile
+        from meshcat.tests import fake_ffmpeg
+        with tempfile.TemporaryDirectory() as tmp_dir, fake_ffmpeg.installed():
+            output_path = os.path.join(tmp_dir, "output.mp4")
+            self.vis.start_recording(output_path, fps=100, format="rgba")
+            self.view(3, lambda i: True)
+            stats = self.vis.stop_recording()
+            with open(output_path, "rb") as f:
+                video = f.read()
+            with open(output_path + ".args") as f:
+                args = f.read().split("\n")
+        self.assertEqual(len(video), stats["frames"] * 3 * 2 * 4)
+        self.assertEqual(args[args.index("-s") + 1], "2x3")
+
+    def test_errors(self):
+        with self.assertRaises(RuntimeError):
+            self.vis.stop_recording()
+        with self.assertRaises(RuntimeError):
+            self.vis.start_recording(fps=30)
+        with self.assertRaises(RuntimeError):
+            self.vis.start_recording(publish_url="inproc://" + self.id(), format="gif")
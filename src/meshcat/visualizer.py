@@ -1,24 +1,84 @@
+import collections
+import concurrent.futures
+import contextlib
 import webbrowser
-import umsgpack
 import numpy as np
 import zmq
 import io
+import json
+import uuid
 from PIL import Image        
 from IPython.display import HTML
 
 
+from . import codec
 from .path import Path
-from .commands import SetObject, SetTransform, Delete, SetProperty, SetAnimation, CaptureImage, SetCamTarget
+from .commands import (SetObject, SetTransform, SetTransforms, Delete, SetProperty, SetAnimation, CaptureImage,
+                       SetCamTarget, StartRecording)
 from .geometry import MeshPhongMaterial
-from .servers.zmqserver import start_zmq_server_as_subprocess
+from .servers.shm import ShmWriter, SHM_MARKER, pack_descriptor
+from .servers.zmqserver import start_zmq_server_as_subprocess, start_zmq_server_as_thread
+
+DEFAULT_TELEMETRY_HWM = 100
+
+# Hosts which a server binds to in order to listen on every interface
+WILDCARD_HOSTS = ["*", "0.0.0.0", "[::]"]
+
 
 class ViewerWindow:
     context = zmq.Context()
 
-    def __init__(self, zmq_url, start_server, server_args):
-        if start_server:
+    def __init__(self, zmq_url, start_server, server_args, max_pending=1, shared_memory=False,
+                 in_process_server=False, telemetry_hwm=DEFAULT_TELEMETRY_HWM):
+        """
+        max_pending is the number of commands which may be in flight to the
+        server before `send` blocks waiting for an acknowledgment. The default
+        of 1 waits for every command to be acknowledged before returning.
+        Larger values pipeline commands, so `send` usually returns immediately.
+        Errors are still raised in the order in which the commands were sent,
+        at the latest when `flush` is called. Large 1-D or Fortran-ordered
+        float32 arrays are sent without being copied (see
+        `geometry.pack_typed_array`), so when pipelining, such arrays passed
+        to `set_object` should not be modified in place until `flush` returns.
+
+        If shared_memory is True and we start the server ourselves, command
+        data is passed to the server through a memory-mapped ring buffer
+        instead of the ZMQ socket (see servers/shm.py). The ring is released
+        by `close`. It can not be combined with in_process_server, since an
+        in-process server is reached without copying anyway.
+
+        If in_process_server is True and we start the server ourselves, it
+        runs on a background thread of this process and is reached over an
+        inproc:// ZMQ socket, rather than being started as a subprocess. This
+        starts much faster, but the server goes down with this process.
+
+        telemetry_hwm is the number of messages sent by `publish` which may
+        be queued for the server before further ones are dropped.
+        """
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1, got {}".format(max_pending))
+        if shared_memory and in_process_server:
+            raise ValueError("shared_memory can not be used with in_process_server")
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        self.batch_frames = None
+        self.shm = None
+        self.server = None
+        self.telemetry_hwm = telemetry_hwm
+        self.telemetry_socket = None
+        self.capture_executor = None
+
+        if start_server and in_process_server:
+            self.server_proc = None
+            self.server, self.zmq_url, self.web_url = start_zmq_server_as_thread(
+                zmq_url=zmq_url, server_args=server_args, context=self.context)
+
+        elif start_server:
+            if shared_memory:
+                self.shm = ShmWriter()
             self.server_proc, self.zmq_url, self.web_url = start_zmq_server_as_subprocess(
-                zmq_url=zmq_url, server_args=server_args)
+                zmq_url=zmq_url, server_args=server_args,
+                shm_path=(self.shm.path if self.shm is not None else None))
 
         else:
             self.server_proc = None
@@ -37,48 +97,251 @@ class ViewerWindow:
         print(self.web_url)
 
     def connect_zmq(self):
-        self.zmq_socket = self.context.socket(zmq.REQ)
+        # A DEALER socket lets us have several requests in flight at once. Each
+        # message starts with an empty delimiter frame so that the server sees
+        # exactly what a REQ socket would have sent.
+        self.zmq_socket = self.context.socket(zmq.DEALER)
         self.zmq_socket.connect(self.zmq_url)
+        self.pending.clear()
+        if self.shm is not None:
+            self.shm.reset()
+
+    def send_frames(self, frames):
+        self.zmq_socket.send_multipart([b""] + frames, copy=False)
+
+    def recv_frames(self):
+        return self.zmq_socket.recv_multipart()[1:]
+
+    def request(self, frames):
+        """
+        Send a single request and block until its reply arrives. Any pipelined
+        commands are flushed first so that replies cannot get mixed up.
+        """
+        self.flush()
+        self.send_frames(frames)
+        return self.recv_frames()[0]
+
+    def recv_ack(self):
+        cmd_type, path, in_shm = self.pending.popleft()
+        reply = self.recv_frames()[0]
+        if in_shm:
+            self.shm.release()
+        if reply.startswith(b"error"):
+            raise RuntimeError("The meshcat server rejected {:s} at path {:s}: {:s}".format(
+                cmd_type, path, reply.decode("utf-8")))
+
+    def flush(self):
+        """
+        Block until all pipelined commands have been acknowledged by the
+        server, raising the first error it reported.
+        """
+        while self.pending:
+            self.recv_ack()
+
+    def close(self):
+        """
+        Close the connection to the server and release the shared-memory
+        ring, if any, and stop the server if it runs in this process.
+        Commands which have not been acknowledged yet are discarded.
+        """
+        self.zmq_socket.close(linger=0)
+        self.pending.clear()
+        if self.telemetry_socket is not None:
+            self.telemetry_socket.close(linger=0)
+            self.telemetry_socket = None
+        if self.capture_executor is not None:
+            self.capture_executor.shutdown(wait=False)
+            self.capture_executor = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+        if self.server is not None:
+            self.server.close()
+            self.server = None
 
     def request_web_url(self):
-        self.zmq_socket.send(b"url")
-        response = self.zmq_socket.recv().decode("utf-8")
-        return response
+        return self.request([b"url"]).decode("utf-8")
 
     def open(self):
         webbrowser.open(self.web_url, new=2)
         return self
 
-    def wait(self):
-        self.zmq_socket.send(b"wait")
-        return self.zmq_socket.recv().decode("utf-8")
+    def wait(self, timeout=None):
+        frames = [b"wait"]
+        if timeout is not None:
+            frames.append(str(timeout).encode("utf-8"))
+        reply = self.request(frames).decode("utf-8")
+        if reply.startswith("error"):
+            raise RuntimeError("The meshcat server did not see a browser connect: " + reply)
+        return reply
 
     def send(self, command):
         cmd_data = command.lower()
-        self.zmq_socket.send_multipart([
+        frames = [
             cmd_data["type"].encode("utf-8"),
             cmd_data["path"].encode("utf-8"),
-            umsgpack.packb(cmd_data)
-        ])
-        self.zmq_socket.recv()
+        ]
+        # Large arrays get ZMQ frames of their own, which are sent without
+        # copying them into the packed message.
+        data_frames = codec.packb_frames(cmd_data)
+        if self.batch_frames is not None:
+            self.batch_frames.extend(frames + [b"".join(data_frames)])
+        else:
+            self.send_command(frames, cmd_data["type"], cmd_data["path"], data_frames)
+
+    def send_command(self, frames, cmd_type, path, data_frames=()):
+        offset = None
+        if self.shm is not None and data_frames:
+            nbytes = sum(memoryview(f).nbytes for f in data_frames)
+            offset = self.shm.allocate(nbytes)
+            while offset is None and self.pending:
+                # The ring is full, so wait for the server to consume some of it
+                self.recv_ack()
+                offset = self.shm.allocate(nbytes)
+        if offset is not None:
+            self.shm.write(offset, data_frames)
+            self.send_frames(frames + [SHM_MARKER, pack_descriptor(offset, nbytes)])
+        else:
+            self.send_frames(frames + list(data_frames))
+        self.pending.append((cmd_type, path, offset is not None))
+        while len(self.pending) >= self.max_pending:
+            self.recv_ack()
+
+    def publish(self, command):
+        """
+        Send a set_transform, set_transforms or set_property command to the
+        server's telemetry socket, without waiting for it to be acknowledged.
+        Commands may be dropped if the server falls behind, and are not
+        ordered with respect to those sent by `send`.
+        """
+        if self.telemetry_socket is None:
+            telemetry_url = connect_url(self.request([b"telemetry_url"]).decode("utf-8"), self.zmq_url)
+            self.telemetry_socket = self.context.socket(zmq.PUB)
+            self.telemetry_socket.setsockopt(zmq.SNDHWM, self.telemetry_hwm)
+            self.telemetry_socket.connect(telemetry_url)
+        if isinstance(command, SetTransform):
+            self.telemetry_socket.send_multipart([
+                b"set_transform", command.path.lower().encode("utf-8"), command.packb()])
+            return
+        cmd_data = command.lower()
+        self.telemetry_socket.send_multipart([
+            cmd_data["type"].encode("utf-8"),
+            cmd_data["path"].encode("utf-8"),
+        ] + codec.packb_frames(cmd_data))
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Collect every command sent inside the `with` block and deliver them to
+        the server as a single message when the block exits. If the block
+        raises, the collected commands are discarded. Nested batches are merged
+        into the outermost one.
+        """
+        if self.batch_frames is not None:
+            yield self
+            return
+        self.batch_frames = []
+        try:
+            yield self
+        finally:
+            frames, self.batch_frames = self.batch_frames, None
+        if frames:
+            self.send_command([b"batch", b""] + frames, "batch", "")
 
     def get_scene(self):
         """Get the static HTML from the ZMQ server."""
-        self.zmq_socket.send(b"get_scene")
         # we receive the HTML as utf-8-encoded, so decode here
-        return self.zmq_socket.recv().decode('utf-8')
+        return self.request([b"get_scene"]).decode('utf-8')
 
-    def get_image(self, w, h):
-        cmd_data = CaptureImage(w, h).lower()
-        self.zmq_socket.send_multipart([
+    def get_stats(self):
+        """Get the send queue statistics of each connected viewer."""
+        return json.loads(self.request([b"stats"]).decode("utf-8"))
+
+    def get_image(self, w, h, timeout=None):
+        cmd_data = CaptureImage(w, h, timeout).lower()
+        img_bytes = self.request([
             cmd_data["type"].encode("utf-8"),
             "".encode("utf-8"),
-            umsgpack.packb(cmd_data)
+            codec.packb(cmd_data)
         ])
-        img_bytes = self.zmq_socket.recv()
+        if img_bytes.startswith(b"error"):
+            raise RuntimeError("The meshcat server could not capture an image: " + img_bytes.decode("utf-8"))
         img = Image.open(io.BytesIO(img_bytes))
         return img
 
+    def get_image_array(self, w, h, format="rgba", timeout=None, viewer=None):
+        self.flush()
+        self.send_frames(capture_image_frames(w, h, format, timeout, viewer))
+        return decode_image(self.recv_frames())
+
+    def start_recording(self, command):
+        cmd_data = command.lower()
+        reply = self.request([cmd_data["type"].encode("utf-8"), b"", codec.packb(cmd_data)])
+        if reply.startswith(b"error"):
+            raise RuntimeError("The meshcat server could not start recording: " + reply.decode("utf-8"))
+
+    def stop_recording(self):
+        reply = self.request([b"stop_recording"])
+        if reply.startswith(b"error"):
+            raise RuntimeError("The meshcat server could not finish the recording: " + reply.decode("utf-8"))
+        return json.loads(reply.decode("utf-8"))
+
+    def get_image_future(self, w, h, format="rgba", timeout=None, viewer=None):
+        # The capture is requested right here, after the commands sent so far
+        # and before any sent later. The server acknowledges it at once and
+        # keeps the image until we collect it on a worker thread.
+        token = uuid.uuid4().hex
+        reply = self.request(capture_image_frames(w, h, format, timeout, viewer, deferred=token))
+        if reply.startswith(b"error"):
+            raise RuntimeError("The meshcat server could not capture an image: " + reply.decode("utf-8"))
+        if self.capture_executor is None:
+            self.capture_executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="meshcat-capture")
+        return self.capture_executor.submit(self.collect_capture, token)
+
+    def collect_capture(self, token):
+        # The server handles one request at a time per socket, so each
+        # capture is waited for on a socket of its own, alongside others.
+        socket = self.context.socket(zmq.DEALER)
+        try:
+            socket.connect(self.zmq_url)
+            socket.send_multipart([b"", b"capture_result", token.encode("utf-8")])
+            return decode_image(socket.recv_multipart()[1:])
+        finally:
+            socket.close(linger=0)
+
+
+def connect_url(url, zmq_url):
+    """
+    The URL to connect to a socket which the server advertises as url. A
+    server bound to every interface advertises a wildcard host, which is
+    replaced by the host we reach the server at, i.e. that of zmq_url.
+    """
+    if not url.startswith("tcp://"):
+        return url
+    host, port = url[len("tcp://"):].rsplit(":", 1)
+    if host not in WILDCARD_HOSTS:
+        return url
+    host = zmq_url[len("tcp://"):].rsplit(":", 1)[0] if zmq_url.startswith("tcp://") else "127.0.0.1"
+    if host in WILDCARD_HOSTS:
+        host = "127.0.0.1"
+    return "tcp://{:s}:{:s}".format(host, port)
+
+
+def capture_image_frames(w, h, format, timeout, viewer, deferred=None):
+    cmd_data = CaptureImage(w, h, timeout, format, viewer, deferred).lower()
+    return [cmd_data["type"].encode("utf-8"), b"", codec.packb(cmd_data)]
+
+
+def decode_image(frames):
+    """Turn the reply to a capture_image request with a format into an array."""
+    if len(frames) == 1:
+        raise RuntimeError("The meshcat server could not capture an image: " + frames[0].decode("utf-8"))
+    header, data = codec.unpackb(frames[0]), frames[1]
+    if header[u"format"] == u"rgba":
+        return np.frombuffer(data, dtype=np.uint8).reshape(header[u"height"], header[u"width"], 4)
+    # A viewer which cannot send raw pixels falls back to an encoded file.
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGBA"))
+
 
 def srcdoc_escape(x):
     return x.replace("&", "&amp;").replace('"', "&quot;")
@@ -87,9 +350,12 @@ def srcdoc_escape(x):
 class Visualizer:
     __slots__ = ["window", "path"]
 
-    def __init__(self, zmq_url=None, window=None, server_args=[]):
+    def __init__(self, zmq_url=None, window=None, server_args=[], max_pending=1, shared_memory=False,
+                 in_process_server=False, telemetry_hwm=DEFAULT_TELEMETRY_HWM):
         if window is None:
-            self.window = ViewerWindow(zmq_url=zmq_url, start_server=(zmq_url is None), server_args=server_args)
+            self.window = ViewerWindow(zmq_url=zmq_url, start_server=(zmq_url is None), server_args=server_args,
+                                       max_pending=max_pending, shared_memory=shared_memory,
+                                       in_process_server=in_process_server, telemetry_hwm=telemetry_hwm)
         else:
             self.window = window
         self.path = Path(("meshcat",))
@@ -107,11 +373,35 @@ class Visualizer:
     def url(self):
         return self.window.web_url
 
-    def wait(self):
+    def wait(self, timeout=None):
         """
-        Block until a browser is connected to the server
+        Block until a browser is connected to the server. If timeout (in
+        seconds) is given and no browser connects in time, raise
+        RuntimeError.
+        """
+        return self.window.wait(timeout)
+
+    def batch(self):
         """
-        return self.window.wait()
+        Group commands into a single message to the server:
+
+            with vis.batch():
+                vis["a"].set_transform(T_a)
+                vis["b"].set_transform(T_b)
+
+        The server applies the whole batch in one pass, which avoids a round
+        trip per command. Viewers still receive the commands one at a time,
+        so they may draw the scene before the whole batch has arrived.
+        """
+        return self.window.batch()
+
+    def flush(self):
+        """
+        Block until every command sent so far has been acknowledged by the
+        server. This only matters if the visualizer was created with
+        max_pending > 1, in which case commands are pipelined.
+        """
+        self.window.flush()
 
     def jupyter_cell(self, height=400):
         """
@@ -151,11 +441,42 @@ class Visualizer:
     def set_transform(self, matrix=np.eye(4)):
         return self.window.send(SetTransform(matrix, self.path))
 
+    def set_transforms(self, paths, matrices):
+        """
+        Set the transforms of many children of this path with one command.
+        `paths` is a list of N paths relative to this one and `matrices` is
+        an Nx4x4 array of homogeneous transforms.
+        """
+        return self.window.send(SetTransforms(matrices, [self.path.append(p) for p in paths]))
+
     def set_property(self, key, value):
         return self.window.send(SetProperty(key, value, self.path))
 
-    def set_animation(self, animation, play=True, repetitions=1):
-        return self.window.send(SetAnimation(animation, play=play, repetitions=repetitions))
+    def publish_transform(self, matrix=np.eye(4)):
+        """
+        Like set_transform, but fire-and-forget: the transform is not
+        acknowledged, and may be dropped if the server falls behind. This is
+        meant for high-rate pose streams, where the next pose soon replaces
+        a lost one.
+        """
+        return self.window.publish(SetTransform(matrix, self.path))
+
+    def publish_transforms(self, paths, matrices):
+        """Like set_transforms, but fire-and-forget (see publish_transform)."""
+        return self.window.publish(SetTransforms(matrices, [self.path.append(p) for p in paths]))
+
+    def publish_property(self, key, value):
+        """Like set_property, but fire-and-forget (see publish_transform)."""
+        return self.window.publish(SetProperty(key, value, self.path))
+
+    def set_animation(self, animation, play=True, repetitions=1, columnar=False):
+        """
+        Send an animation to the viewer. With columnar=True, each track is
+        sent as Float32Arrays of times and values, which is much smaller and
+        faster to encode, but needs a viewer which decodes typed arrays in
+        animation tracks. By default, tracks are sent as lists of keys.
+        """
+        return self.window.send(SetAnimation(animation, play=play, repetitions=repetitions, columnar=columnar))
 
     def set_cam_target(self, value):
         """Set camera target (in right-handed coordinates (x,y,z))."""
@@ -166,13 +487,64 @@ class Visualizer:
     def set_cam_pos(self, value):
         """Set camera position (in right-handed coordinates (x,y,z))."""
         path = "/Cameras/default/rotated/<object>"
-        v = list(value)
+        v = np.array(value, dtype=np.float64)
         v[1], v[2] = v[2], -v[1]  # convert to left-handed (x,z,-y)
         return self[path].set_property("position", v)
 
-    def get_image(self, w=None, h=None):
-        """Save an image"""
-        return self.window.get_image(w, h)
+    def get_image(self, w=None, h=None, timeout=None):
+        """
+        Save an image. If no browser is connected, wait for one for up to
+        timeout seconds (forever by default), and then raise RuntimeError.
+        """
+        return self.window.get_image(w, h, timeout)
+
+    def get_image_array(self, w=None, h=None, format="rgba", timeout=None, viewer=None):
+        """
+        Capture an image as a (height, width, 4) uint8 array of RGBA pixels.
+        The viewer sends the image as a binary frame, either as raw pixels
+        (format="rgba"), which need no decoding, or as a "png" or "jpeg" file,
+        which is smaller to send. Waits for a browser like get_image.
+
+        If viewer is given, only the viewer with that ID (see `stats`) is
+        asked for the image, and it must already be connected.
+        """
+        return self.window.get_image_array(w, h, format, timeout, viewer)
+
+    def get_image_future(self, w=None, h=None, format="rgba", timeout=None, viewer=None):
+        """
+        Like get_image_array, but return a concurrent.futures.Future of the
+        image right away, so that several captures, e.g. one from each open
+        viewer, can be in flight at once.
+        """
+        return self.window.get_image_future(w, h, format, timeout, viewer)
+
+    def start_recording(self, filename=None, fps=30, format="png", w=None, h=None, publish_url=None, viewer=None):
+        """
+        Start capturing frames from the viewer fps times per second. The
+        server pipes them into ffmpeg as they arrive, to encode the video
+        file filename (a path on the server's machine), or publishes them on
+        a ZMQ PUB socket bound to publish_url, as a msgpack header followed by
+        the image data. format is "png", "jpeg" or "rgba", as for
+        get_image_array.
+        """
+        return self.window.start_recording(StartRecording(filename, fps, format, w, h, publish_url, viewer))
+
+    def stop_recording(self):
+        """
+        Stop recording, wait for ffmpeg to finish the video, and return a
+        dict with the number of "frames" recorded and of "skipped" ticks,
+        when the previous frame hadn't arrived yet.
+        """
+        return self.window.stop_recording()
+
+    def stats(self):
+        """
+        Return a list with one dict per connected viewer, giving its "id",
+        its "remote_ip", the number of messages "queued" for it, the number of
+        superseded messages "dropped" from its queue, and whether it was
+        disconnected because its queue "overflowed".
+        """
+        return self.window.get_stats()
 
     def delete(self):
         return self.window.send(Delete(self.path))
@@ -0,0 +1,40 @@
+"""
+Compare the msgpack backends available to meshcat on representative
+set_object and set_transform payloads.
+
+Usage: python utils/codec_timing.py
+"""
+import timeit
+
+import numpy as np
+
+from meshcat.codec import UmsgpackCodec, MsgpackCodec
+from meshcat.commands import SetObject, SetTransform
+from meshcat.path import Path
+import meshcat.geometry as g
+import meshcat.transformations as tf
+
+
+def main():
+    codecs = [UmsgpackCodec()]
+    try:
+        codecs.append(MsgpackCodec())
+    except ImportError:
+        print("msgpack is not installed, only timing umsgpack")
+
+    path = Path(("meshcat", "robot", "link_1"))
+    verts = np.random.rand(3, 1000000).astype(np.float32)
+    payloads = [
+        ("set_transform", SetTransform(tf.random_rotation_matrix(), path).lower(), 20000),
+        ("set_object box", SetObject(g.Box([1, 2, 3]), path=path).lower(), 5000),
+        ("set_object 1M points", SetObject(g.PointCloud(verts, verts), path=path).lower(), 20),
+    ]
+    for name, data, N in payloads:
+        for codec in codecs:
+            duration = timeit.timeit(lambda: codec.packb(data), number=N)
+            print("{:>22s} {:>9s}: {:10.2f} us per command".format(
+                name, codec.name, duration / N * 1e6))
+
+
+if __name__ == '__main__':
+    main()
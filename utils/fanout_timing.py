@@ -0,0 +1,79 @@
+"""
+Measure how long a producer waits for the server to acknowledge a
+set_transform as the number of connected viewers grows, with the viewers
+served from the server's fanout thread (the default) and from the same
+thread as the ZMQ socket (--no-fanout-thread).
+
+Each viewer is a websocket connection from a helper process which reads and
+discards every message.
+
+Usage: python utils/fanout_timing.py
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import meshcat
+import meshcat.geometry as g
+import meshcat.transformations as tf
+
+
+def run_viewers(port, count):
+    import asyncio
+    import tornado.websocket
+
+    async def view():
+        websocket = await tornado.websocket.websocket_connect("ws://127.0.0.1:{:d}/".format(port))
+        while await websocket.read_message() is not None:
+            pass
+
+    async def main():
+        await asyncio.gather(*[view() for _ in range(count)])
+
+    asyncio.run(main())
+
+
+def measure(server_args, viewers, N=2000):
+    vis = meshcat.Visualizer(server_args=server_args)
+    port = int(vis.url().split(":")[-1].split("/")[0])
+    proc = subprocess.Popen([sys.executable, __file__, "--viewers", str(viewers), "--port", str(port)])
+    try:
+        while len(vis.stats()) < viewers:
+            time.sleep(0.01)
+        # Give each viewer something to render, so that transforms are not
+        # the only traffic.
+        for i in range(10):
+            vis["robot"][str(i)].set_object(g.Box([0.1, 0.1, 0.1]))
+        matrix = tf.random_rotation_matrix()
+        durations = np.empty(N)
+        for i in range(N):
+            start = time.perf_counter()
+            vis["robot"][str(i % 10)].set_transform(matrix)
+            durations[i] = time.perf_counter() - start
+        return np.median(durations), np.percentile(durations, 99)
+    finally:
+        proc.kill()
+        vis.window.server_proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--viewers", type=int)
+    parser.add_argument("--port", type=int)
+    args = parser.parse_args()
+    if args.port is not None:
+        run_viewers(args.port, args.viewers)
+        return
+
+    for name, server_args in [("fanout thread", []), ("single thread", ["--no-fanout-thread"])]:
+        for viewers in [1, 10, 30, 100]:
+            median, p99 = measure(server_args, viewers)
+            print("{:>14s}, {:3d} viewers: median {:7.1f} us, 99th percentile {:7.1f} us per set_transform".format(
+                name, viewers, median * 1e6, p99 * 1e6))
+
+
+if __name__ == '__main__':
+    main()
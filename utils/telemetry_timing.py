@@ -0,0 +1,34 @@
+"""
+Compare the time it takes to send a set_transform command and wait for its
+acknowledgment with the time it takes to publish it to the server's
+telemetry socket.
+
+Usage: python utils/telemetry_timing.py
+"""
+import time
+
+import numpy as np
+
+import meshcat
+import meshcat.transformations as tf
+
+
+def main():
+    N = 20000
+    vis = meshcat.Visualizer()
+    v = vis["robot"]
+    matrix = tf.random_rotation_matrix()
+    v.publish_transform(matrix)
+
+    for name, send in [("set_transform", v.set_transform), ("publish_transform", v.publish_transform)]:
+        durations = np.empty(N)
+        for i in range(N):
+            start = time.perf_counter()
+            send(matrix)
+            durations[i] = time.perf_counter() - start
+        print("{:>18s}: median {:7.2f} us, 99th percentile {:7.2f} us per command".format(
+            name, np.median(durations) * 1e6, np.percentile(durations, 99) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
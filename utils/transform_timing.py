@@ -0,0 +1,37 @@
+"""
+Compare the cost of encoding set_transform commands with the matrix packed
+as a list of 16 floats (the old format) and as a single Float32Array
+extension (the current format).
+
+Usage: python utils/transform_timing.py
+"""
+import timeit
+
+import umsgpack
+
+from meshcat.commands import SetTransform
+from meshcat.path import Path
+import meshcat.transformations as tf
+
+
+def lower_as_list(cmd):
+    return {
+        u"type": u"set_transform",
+        u"path": cmd.path.lower(),
+        u"matrix": list(cmd.matrix.T.flatten())
+    }
+
+
+def main():
+    N = 20000
+    cmd = SetTransform(tf.random_rotation_matrix(), Path(("meshcat", "robot", "link_1")))
+
+    for name, lower in [("list", lower_as_list), ("Float32Array", lambda c: c.lower())]:
+        packed = umsgpack.packb(lower(cmd))
+        duration = timeit.timeit(lambda: umsgpack.packb(lower(cmd)), number=N)
+        print("{:>14s}: {:6.2f} us per command, {:d} bytes".format(
+            name, duration / N * 1e6, len(packed)))
+
+
+if __name__ == '__main__':
+    main()